@@ -0,0 +1,171 @@
+import collections
+import datetime
+import os
+import random
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Union
+
+from telethon.errors import FloodWaitError
+from telethon.tl.functions.messages import GetHistoryRequest
+from telethon.tl.types import Document, MessageActionChatAddUser, MessageActionChatDeleteUser, MessageMediaDocument, \
+    MessageMediaPhoto, Photo
+
+WORDS = ["hello", "telegram", "pisg", "stats", "log", "chat", "what", "yes", "no", "the", "a", "is", "lol", "ok"]
+
+
+class FakeUser:
+
+    def __init__(self, user_id: int, first_name: Optional[str], last_name: Optional[str] = None,
+                 photo_id: Optional[int] = None):
+        self.id = user_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.photo = None if photo_id is None else SimpleNamespace(photo_id=photo_id)
+
+
+class FakeChat:
+
+    def __init__(self, chat_id: int, title: str):
+        self.id = chat_id
+        self.title = title
+
+
+class FakeMessage:
+
+    def __init__(self, message_id: int, date: datetime.datetime, sender: FakeUser, text: str = "",
+                 action=None, media=None):
+        self.id = message_id
+        self.date = date
+        self.sender = sender
+        self.text = text
+        self.action = action
+        self.media = media
+
+
+# Local stand-in for the parts of TelegramClient this project uses, replaying a fixed message history
+class FakeClient:
+
+    def __init__(self, chats: Dict[str, FakeChat], histories: Dict[str, List[FakeMessage]],
+                 users: Dict[int, FakeUser]):
+        self.chats = chats
+        self.histories = {handle: sorted(messages, key=lambda m: m.id) for handle, messages in histories.items()}
+        self.users = users
+        self.flood_waits = collections.defaultdict(list)
+        self.request_counts = collections.Counter()
+
+    def inject_flood_wait(self, handle: str, seconds: int, after_messages: int = 0):
+        # The next iter_messages() call on this chat raises FloodWaitError after yielding `after_messages` messages
+        self.flood_waits[handle].append((seconds, after_messages))
+
+    def _resolve(self, entity):
+        if isinstance(entity, (FakeChat, FakeUser)):
+            return entity
+        if entity in self.chats:
+            return self.chats[entity]
+        if str(entity) in self.chats:
+            return self.chats[str(entity)]
+        return self.users[int(entity)]
+
+    def _handle(self, entity) -> str:
+        chat = self._resolve(entity)
+        return next(handle for handle, value in self.chats.items() if value is chat)
+
+    async def get_entity(self, entity: Union[str, int, List]):
+        self.request_counts["get_entity"] += 1
+        if isinstance(entity, list):
+            return [self._resolve(e) for e in entity]
+        return self._resolve(entity)
+
+    async def __call__(self, request):
+        if not isinstance(request, GetHistoryRequest):
+            raise NotImplementedError(f"FakeClient does not support {type(request).__name__}")
+        self.request_counts["get_history"] += 1
+        history = self.histories[self._handle(request.peer)]
+        count = len([message for message in history if message.id > (request.min_id or 0)])
+        return SimpleNamespace(count=count, messages=history[-request.limit:])
+
+    async def iter_messages(self, entity, limit: Optional[int] = None, *, offset_id: int = 0, max_id: int = 0,
+                            min_id: int = 0, reverse: bool = False, **kwargs):
+        self.request_counts["iter_messages"] += 1
+        handle = self._handle(entity)
+        messages = [
+            message for message in self.histories[handle]
+            if message.id > min_id and (not max_id or message.id < max_id)
+        ]
+        if reverse:
+            messages = [message for message in messages if message.id > offset_id]
+        else:
+            messages = [message for message in messages[::-1] if not offset_id or message.id < offset_id]
+        if limit is not None:
+            messages = messages[:limit]
+        flood_wait = self.flood_waits[handle].pop(0) if self.flood_waits[handle] else None
+        for num, message in enumerate(messages):
+            if flood_wait is not None and num == flood_wait[1]:
+                raise FloodWaitError(request=None, capture=flood_wait[0])
+            yield message
+        if flood_wait is not None and len(messages) <= flood_wait[1]:
+            raise FloodWaitError(request=None, capture=flood_wait[0])
+
+    async def download_profile_photo(self, entity, file: Optional[str] = None, **kwargs) -> Optional[str]:
+        self.request_counts["download_profile_photo"] += 1
+        user = self._resolve(entity)
+        if user.photo is None:
+            return None
+        os.makedirs(os.path.dirname(file) or ".", exist_ok=True)
+        with open(file, "wb") as f:
+            f.write(str(user.photo.photo_id).encode())
+        return file
+
+
+def generate_fake_client(
+        chat_count: int = 1,
+        message_count: int = 10000,
+        user_count: int = 100,
+        multi_line_ratio: float = 0.2,
+        media_ratio: float = 0.1,
+        join_quit_ratio: float = 0.01,
+        photo_ratio: float = 0.5,
+        seed: int = 0
+) -> FakeClient:
+    # Builds a FakeClient with synthetic chats, for benchmarking without a Telegram login
+    rng = random.Random(seed)
+    users = {
+        user_id: FakeUser(
+            user_id,
+            f"User{user_id}" if rng.random() > 0.02 else None,
+            f"Surname{user_id}" if rng.random() > 0.5 else None,
+            photo_id=user_id * 1000 if rng.random() < photo_ratio else None
+        )
+        for user_id in range(1, user_count + 1)
+    }
+    user_list = list(users.values())
+    chats = {}
+    histories = {}
+    start = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)
+    for chat_num in range(chat_count):
+        handle = str(1000 + chat_num)
+        chats[handle] = FakeChat(1000 + chat_num, f"Chat {chat_num}")
+        date = start
+        messages = []
+        for message_id in range(1, message_count + 1):
+            date += datetime.timedelta(seconds=rng.randint(1, 600))
+            sender = rng.choice(user_list)
+            roll = rng.random()
+            if roll < join_quit_ratio:
+                action = MessageActionChatAddUser([sender.id]) if rng.random() < 0.5 \
+                    else MessageActionChatDeleteUser(sender.id)
+                messages.append(FakeMessage(message_id, date, sender, action=action))
+            elif roll < join_quit_ratio + media_ratio:
+                if rng.random() < 0.5:
+                    media = MessageMediaPhoto(photo=Photo(message_id, 0, b"", date, [], 1))
+                else:
+                    media = MessageMediaDocument(document=Document(message_id, 0, b"", date, "", 0, 1, []))
+                messages.append(FakeMessage(message_id, date, sender, media=media))
+            else:
+                line_count = rng.randint(2, 8) if rng.random() < multi_line_ratio else 1
+                text = "\n".join(
+                    " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 15))) for _ in range(line_count)
+                )
+                messages.append(FakeMessage(message_id, date, sender, text=text))
+        histories[handle] = messages
+    return FakeClient(chats, histories, users)
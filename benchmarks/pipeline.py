@@ -0,0 +1,107 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+from telegram_logger.chat_log import DEFAULT_BATCH_SIZE
+from telegram_logger.data_store import DataStore
+from telegram_logger.database import Database
+from benchmarks.fake_client import generate_fake_client
+from telegram_logger.log_entry import LogEntry
+
+
+@contextmanager
+def timed(results: Dict, phase: str):
+    start = time.perf_counter()
+    yield
+    results[phase] = time.perf_counter() - start
+
+
+async def run_phases(args) -> Dict:
+    client = generate_fake_client(
+        chat_count=args.chats,
+        message_count=args.messages,
+        user_count=args.users,
+        multi_line_ratio=args.multi_line_ratio,
+        media_ratio=args.media_ratio,
+        seed=args.seed
+    )
+    results = {}
+    database = Database("sqlite:///scrape.db")
+    data_store = DataStore(database, list(client.chats.keys()))
+    with timed(results, "scrape"):
+        await data_store.update_all_logs(client, args.concurrency, args.batch_size)
+    entry_count = database.count_log_entries()
+
+    # Inserts the same entries into a fresh database, to time the database side of scraping on its own
+    insert_database = Database("sqlite:///insert.db")
+    chat_entries = {
+        handle: [
+            (message.id, LogEntry.entries_from_message(message, client.chats[handle].title))
+            for message in messages
+        ]
+        for handle, messages in client.histories.items()
+    }
+    with timed(results, "insert"):
+        for handle, entries in chat_entries.items():
+            chat_log = insert_database.get_chat_log(handle)
+            for message_id, log_entries in entries:
+                chat_log.add_entries(log_entries, message_id, args.batch_size)
+            chat_log.flush_entries()
+
+    with timed(results, "render"):
+        await data_store.write_all_logs(client, args.render_workers, args.compress_closed_days)
+    with timed(results, "cfg"):
+        await data_store.write_users_cfg(client)
+        await data_store.write_channel_cfg(client)
+
+    total_messages = args.chats * args.messages
+    return {
+        "messages": total_messages,
+        "log_entries": entry_count,
+        "phases": {
+            phase: {
+                "seconds": round(duration, 4),
+                "messages_per_second": round(total_messages / duration) if duration else None
+            }
+            for phase, duration in results.items()
+        },
+        "rpc_counts": dict(client.request_counts)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each phase of a run against a fake client and sqlite")
+    parser.add_argument("--chats", type=int, default=2)
+    parser.add_argument("--messages", type=int, default=20000, help="Messages per chat")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--multi-line-ratio", type=float, default=0.2)
+    parser.add_argument("--media-ratio", type=float, default=0.1)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--render-workers", type=int, default=1)
+    parser.add_argument("--compress-closed-days", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # The logs and cfg files are written relative to the working directory
+        os.chdir(work_dir)
+        try:
+            report = asyncio.run(run_phases(args))
+        finally:
+            os.chdir(start_dir)
+    print(json.dumps(report, indent=2))
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import datetime
+import random
+import time
+
+from telegram_logger.database import Database
+from telegram_logger.log_entry import LogEntry
+
+
+def legacy_to_log_line(entry: LogEntry, user_id_lookup) -> str:
+    # The rendering path before the formatter table, kept here as the baseline to compare against
+    time_str = entry.log_datetime.time().isoformat()
+    user_name = user_id_lookup[entry.user_id]
+    if entry.log_type == LogEntry.TYPE_QUIT:
+        return f"{time_str} -!- {user_name} {entry.text}"
+    elif entry.log_type == LogEntry.TYPE_JOIN:
+        return f"{time_str} -!- {user_name} {entry.text}"
+    elif entry.log_type == LogEntry.TYPE_TEXT:
+        return f"{time_str} < {user_name}> {entry.text}"
+    elif entry.log_type == LogEntry.TYPE_ACTION:
+        return f"{time_str} * {user_name} {entry.text}"
+
+
+def build_rows(line_count: int, user_count: int):
+    database = Database("sqlite://")
+    database.get_chat_log("bench")
+    start = datetime.datetime(2020, 1, 1)
+    types = [LogEntry.TYPE_TEXT] * 8 + [LogEntry.TYPE_ACTION, LogEntry.TYPE_JOIN]
+    entries = [
+        LogEntry(
+            start + datetime.timedelta(seconds=13 * num),
+            random.choice(types),
+            random.randrange(user_count),
+            f"line of text number {num}",
+            num,
+            0
+        )
+        for num in range(line_count)
+    ]
+    database.insert_log_entries("bench", entries)
+    query = database.log_entries.select().where(database.log_entries.columns.chat_handle == "bench")
+    return database.conn.execute(query).fetchall()
+
+
+def time_lines(name: str, render, rows) -> float:
+    start = time.perf_counter()
+    lines = [render(row) for row in rows]
+    duration = time.perf_counter() - start
+    print(f"{name}: {len(lines) / duration:,.0f} lines/sec")
+    return duration
+
+
+def run(line_count: int, user_count: int):
+    rows = build_rows(line_count, user_count)
+    user_id_lookup = {user_id: f"User{user_id}" for user_id in range(user_count)}
+    legacy = [legacy_to_log_line(LogEntry.from_row(row), user_id_lookup) for row in rows]
+    fast = [LogEntry.log_line_from_row(row, user_id_lookup) for row in rows]
+    assert legacy == fast, "Fast path output differs from the legacy path"
+    before = time_lines(
+        "before (LogEntry + if/elif)",
+        lambda row: legacy_to_log_line(LogEntry.from_row(row), user_id_lookup),
+        rows
+    )
+    after = time_lines(
+        "after (row fast path)",
+        lambda row: LogEntry.log_line_from_row(row, user_id_lookup),
+        rows
+    )
+    print(f"speedup: {before / after:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare log line rendering throughput")
+    parser.add_argument("--lines", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=500)
+    args = parser.parse_args()
+    run(args.lines, args.users)
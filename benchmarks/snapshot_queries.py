@@ -0,0 +1,44 @@
+import argparse
+import time
+
+import numpy
+
+from telegram_logger.snapshot import COLUMN_TYPES, Snapshot
+
+
+def build_snapshot(row_count: int, user_count: int, seed: int) -> Snapshot:
+    # Builds the columns directly, as exporting millions of rows through sqlite would dominate the run
+    rng = numpy.random.default_rng(seed)
+    start = numpy.datetime64("2015-01-01T00:00:00", "s").astype("int64")
+    timestamps = numpy.sort(rng.integers(start, start + 10 * 365 * 86400, row_count))
+    columns = {
+        "datetime": timestamps.astype(COLUMN_TYPES["datetime"]),
+        "user_id": rng.integers(1, user_count + 1, row_count).astype(COLUMN_TYPES["user_id"]),
+        "entry_type": rng.choice([0] * 8 + [1, 2, 3], row_count).astype(COLUMN_TYPES["entry_type"]),
+        "message_id": numpy.arange(row_count, dtype=COLUMN_TYPES["message_id"])
+    }
+    return Snapshot(columns, numpy.zeros(row_count + 1, dtype="int64"), numpy.zeros(0, dtype="uint8"))
+
+
+def time_query(name: str, query) -> None:
+    start = time.perf_counter()
+    query()
+    print(f"{name}: {time.perf_counter() - start:.3f}s")
+
+
+def run(row_count: int, user_count: int, seed: int):
+    snapshot = build_snapshot(row_count, user_count, seed)
+    print(f"{len(snapshot):,} rows")
+    time_query("per day", lambda: snapshot.counts_per_day())
+    time_query("per day, one user", lambda: snapshot.counts_per_day(user_id=1))
+    time_query("per user", lambda: snapshot.counts_per_user())
+    time_query("per hour, text only", lambda: snapshot.counts_per_hour(entry_types=["TEXT"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the vectorised snapshot queries")
+    parser.add_argument("--rows", type=int, default=5_000_000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    run(args.rows, args.users, args.seed)
@@ -1,17 +1,41 @@
+import argparse
 import asyncio
+import datetime
 import json
 import sys
-from typing import Dict
-
-import telethon
-from telethon.tl.types import InputPeerChannel
+from typing import Dict, List, Optional
 
+from telegram_logger.chat_log import DEFAULT_BATCH_SIZE
 from telegram_logger.data_store import DataStore
 from telegram_logger.database import Database
+from telegram_logger.instrumentation import instrumentation
+from telegram_logger.stats import SERIES_DAY, SERIES_USER, SERIES_HOUR, FORMAT_CSV, FORMAT_JSON, resolve_chat_handle, \
+    list_stats, format_stats
 from telegram_logger.telegram_utils import get_chat_name
 
+COMMAND_SCRAPE = "scrape"
+COMMAND_RENDER = "render"
+COMMAND_CFG = "cfg"
+COMMAND_ALL = "all"
+COMMAND_STEPS = {
+    COMMAND_SCRAPE: [COMMAND_SCRAPE],
+    COMMAND_RENDER: [COMMAND_RENDER],
+    COMMAND_CFG: [COMMAND_CFG],
+    COMMAND_ALL: [COMMAND_SCRAPE, COMMAND_RENDER, COMMAND_CFG]
+}
+
+
+def create_client(conf: Dict):
+    # Telethon is only imported by the commands which talk to Telegram, so offline commands start quickly
+    import telethon
+    client_class = instrumentation.instrument_client_class(telethon.TelegramClient)
+    client = client_class('log_converter', conf["api_id"], conf["api_hash"])
+    client.start()
+    return client
+
 
 async def add_channel(data_store, client):
+    from telethon.tl.types import InputPeerChannel
     print("- Listing new chat options:")
     dialogs = await client.get_dialogs()
     entities = [chan for chan in dialogs if isinstance(chan.input_entity, InputPeerChannel) and chan.entity.megagroup]
@@ -30,8 +54,8 @@ async def add_channel(data_store, client):
 
 
 async def ask_questions(data_store, client):
-    chat_entities = await asyncio.gather(*(client.get_entity(chat_log.handle) for chat_log in data_store.chat_logs))
-    chat_names = [get_chat_name(entity) for entity in chat_entities]
+    await data_store.entity_cache.load_chats(client, data_store.chat_handles)
+    chat_names = [data_store.entity_cache.chat_name(chat_handle) for chat_handle in data_store.chat_handles]
     print("- Currently generating stats for these channels: " + ", ".join(chat_names))
     more_channels = input("Would you like to add any new chats? [n]: ")
     if more_channels.lower().strip() not in ["yes", "y"]:
@@ -42,32 +66,192 @@ async def ask_questions(data_store, client):
     print(" - Finished adding new chats")
 
 
-async def update_data(client, skip_questions: bool, db_conn_str: str):
+async def update_data(
+        client,
+        skip_questions: bool,
+        db_conn_str: str,
+        steps: Optional[List[str]] = None,
+        scrape_concurrency: int = 4,
+        insert_batch_size: int = DEFAULT_BATCH_SIZE,
+        entity_cache_ttl: datetime.timedelta = datetime.timedelta(days=1),
+        photo_concurrency: int = 8,
+        render_workers: int = 1,
+        compress_closed_days: bool = False,
+        metrics_report: Optional[str] = None,
+        metrics_textfile: Optional[str] = None
+):
+    # Without a client, only the render and cfg steps can run, using the database and cached names
+    steps = steps or COMMAND_STEPS[COMMAND_ALL]
     print("Setup database")
-    database = Database(db_conn_str)
+    with instrumentation.phase("setup"):
+        database = Database(db_conn_str)
     print("Loading data store")
     data_store = DataStore.load_from_json(database)
-    if not skip_questions:
-        await ask_questions(data_store, client)
-    print("Updating logs")
-    await data_store.update_all_logs(client)
-    print("Saving data store")
-    data_store.save_to_json()
-    print("Writing logs")
-    await data_store.write_all_logs(client)
-    print("Writing users config")
-    await data_store.write_users_cfg(client)
-    print("Writing channel config")
-    await data_store.write_channel_cfg(client)
-
-
-def run(conf: Dict, skip_questions: bool):
-    client = telethon.TelegramClient('log_converter', conf["api_id"], conf["api_hash"])
-    client.start()
-    client.loop.run_until_complete(update_data(client, skip_questions, conf["db_conn"]))
+    data_store.entity_cache.ttl = entity_cache_ttl
+    if COMMAND_SCRAPE in steps:
+        if not skip_questions:
+            await ask_questions(data_store, client)
+        print("Updating logs")
+        with instrumentation.phase("scrape"):
+            await data_store.update_all_logs(client, scrape_concurrency, insert_batch_size)
+        print("Saving data store")
+        data_store.save_to_json()
+    if COMMAND_RENDER in steps:
+        print("Writing logs")
+        with instrumentation.phase("render"):
+            await data_store.write_all_logs(client, render_workers, compress_closed_days)
+    if COMMAND_CFG in steps:
+        print("Writing users config")
+        with instrumentation.phase("users_cfg"):
+            await data_store.write_users_cfg(client, photo_concurrency)
+        print("Writing channel config")
+        with instrumentation.phase("channel_cfg"):
+            await data_store.write_channel_cfg(client)
+    if metrics_report:
+        instrumentation.write_json(metrics_report)
+    if metrics_textfile:
+        instrumentation.write_prometheus(metrics_textfile)
+
+
+async def listen_for_messages(client, conf: Dict):
+    from telegram_logger.live_ingester import LiveIngester
+    database = Database(conf["db_conn"])
+    data_store = DataStore.load_from_json(database)
+    data_store.entity_cache.ttl = datetime.timedelta(hours=conf.get("entity_cache_ttl_hours", 24))
+    ingester = LiveIngester(
+        data_store,
+        client,
+        batch_size=conf.get("live_batch_size", 50),
+        flush_interval=conf.get("live_flush_seconds", 30),
+        scrape_concurrency=conf.get("scrape_concurrency", 4),
+        scrape_batch_size=conf.get("insert_batch_size", DEFAULT_BATCH_SIZE),
+        compress_closed_days=conf.get("compress_closed_days", False)
+    )
+    await ingester.run()
+
+
+def run_daemon(conf: Dict):
+    client = create_client(conf)
+    client.loop.run_until_complete(listen_for_messages(client, conf))
+
+
+def print_stats(conf: Dict, args: List[str]):
+    parser = argparse.ArgumentParser(prog="convert_to_irssi_logs.py stats")
+    parser.add_argument("chat", help="Chat handle, or chat name")
+    parser.add_argument("--by", choices=[SERIES_DAY, SERIES_USER, SERIES_HOUR], default=SERIES_DAY)
+    parser.add_argument("--user", type=int, help="Only count this user ID, for the per-day series")
+    parser.add_argument("--format", choices=[FORMAT_CSV, FORMAT_JSON], default=FORMAT_CSV)
+    parser.add_argument("--rebuild", action="store_true", help="Recalculate the chat's rollups from its log entries")
+    parsed = parser.parse_args(args)
+    database = Database(conf["db_conn"])
+    chat_handle = resolve_chat_handle(database, parsed.chat)
+    if parsed.rebuild:
+        database.rebuild_stats(chat_handle)
+    rows = list_stats(database, chat_handle, parsed.by, parsed.user)
+    print(format_stats(rows, parsed.format), end="")
+
+
+def export_snapshots(conf: Dict, args: List[str]):
+    # Imported here, so numpy is only needed for snapshots
+    from telegram_logger.snapshot import export_snapshot
+    parser = argparse.ArgumentParser(prog="convert_to_irssi_logs.py snapshot")
+    parser.add_argument("chats", nargs="*", help="Chat handles, or chat names. Defaults to every chat")
+    parser.add_argument("--output", default="snapshots", help="Directory to write the snapshots to")
+    parsed = parser.parse_args(args)
+    database = Database(conf["db_conn"])
+    chat_handles = [resolve_chat_handle(database, chat) for chat in parsed.chats] or database.list_chat_handles()
+    for chat_handle in chat_handles:
+        added_rows = export_snapshot(database, chat_handle, parsed.output)
+        print(f"- Added {added_rows} entries to the {chat_handle} snapshot")
+
+
+def verify_logs(conf: Dict, args: List[str]):
+    parser = argparse.ArgumentParser(prog="convert_to_irssi_logs.py verify")
+    parser.add_argument("chats", nargs="*", help="Chat handles, or chat names. Defaults to every chat")
+    parser.add_argument(
+        "--reset",
+        nargs=2,
+        type=int,
+        metavar=("START_ID", "END_ID"),
+        help="Mark this range of message IDs of one chat as not fetched, so the next scrape fetches it again"
+    )
+    parsed = parser.parse_args(args)
+    if parsed.reset and len(parsed.chats) != 1:
+        parser.error("--reset needs exactly one chat")
+    database = Database(conf["db_conn"])
+    known_handles = database.list_chat_handles()
+    chat_handles = [resolve_chat_handle(database, chat) for chat in parsed.chats] or known_handles
+    for chat_handle in chat_handles:
+        if chat_handle not in known_handles:
+            print(f"- {chat_handle}: not a logged chat")
+            continue
+        if parsed.reset:
+            database.remove_fetched_range(chat_handle, *parsed.reset)
+        last_message_id = database.get_chat_log(chat_handle).last_message_id
+        missing_ranges = database.list_missing_ranges(chat_handle, last_message_id)
+        missing_count = sum(end_id - start_id + 1 for start_id, end_id in missing_ranges)
+        print(f"- {chat_handle}: {len(missing_ranges)} gaps, {missing_count} message IDs missing")
+        for start_id, end_id in missing_ranges:
+            print(f"  - {start_id} to {end_id}")
+
+
+def run(conf: Dict, skip_questions: bool, command: str = COMMAND_ALL):
+    instrumentation.profile_phase = conf.get("profile_phase")
+    instrumentation.profile_output = conf.get("profile_output")
+    steps = COMMAND_STEPS[command]
+    # Rendering and writing the cfg files only need a Telegram login when scraping too
+    client = create_client(conf) if COMMAND_SCRAPE in steps else None
+    coroutine = update_data(
+        client,
+        skip_questions,
+        conf["db_conn"],
+        steps,
+        scrape_concurrency=conf.get("scrape_concurrency", 4),
+        insert_batch_size=conf.get("insert_batch_size", DEFAULT_BATCH_SIZE),
+        entity_cache_ttl=datetime.timedelta(hours=conf.get("entity_cache_ttl_hours", 24)),
+        photo_concurrency=conf.get("photo_download_concurrency", 8),
+        render_workers=conf.get("render_workers", 1),
+        compress_closed_days=conf.get("compress_closed_days", False),
+        metrics_report=conf.get("metrics_report"),
+        metrics_textfile=conf.get("metrics_textfile")
+    )
+    if client is None:
+        asyncio.run(coroutine)
+    else:
+        client.loop.run_until_complete(coroutine)
+
+
+def main(conf: Dict, args: List[str]):
+    if args[:1] == ["stats"]:
+        print_stats(conf, args[1:])
+    elif args[:1] == ["snapshot"]:
+        export_snapshots(conf, args[1:])
+    elif args[:1] == ["verify"]:
+        verify_logs(conf, args[1:])
+    elif args[:1] == ["daemon"]:
+        run_daemon(conf)
+    else:
+        parser = argparse.ArgumentParser(
+            prog="convert_to_irssi_logs.py",
+            epilog="Other commands: stats, snapshot, verify and daemon. Pass --help after one for its options."
+        )
+        parser.add_argument(
+            "command",
+            nargs="?",
+            choices=list(COMMAND_STEPS.keys()),
+            default=COMMAND_ALL,
+            help="scrape new messages, render the irssi logs, write the pisg cfg files, or all three (the default). "
+                 "render and cfg work offline, from the database and cached names."
+        )
+        parser.add_argument("skip", nargs="?", choices=["skip"], help="Skip the questions about adding new chats")
+        # Kept working without a command, as "convert_to_irssi_logs.py skip"
+        if args[:1] == ["skip"]:
+            args = [COMMAND_ALL] + args
+        parsed = parser.parse_args(args)
+        run(conf, parsed.skip is not None, parsed.command)
 
 
 if __name__ == "__main__":
     with open("config.json", "r") as conf_file:
         config = json.load(conf_file)
-    run(config, "skip" in sys.argv)
+    main(config, sys.argv[1:])
@@ -1,65 +1,318 @@
 import datetime
+import gzip
+import io
 import os
-from typing import Optional, List, TYPE_CHECKING
+from contextlib import contextmanager
+from concurrent.futures import Executor, Future
+from typing import Optional, List, Tuple, TYPE_CHECKING
 
 from tqdm import tqdm
 
+from telegram_logger.instrumentation import instrumentation
 from telegram_logger.log_entry import LogEntry
 from telegram_logger.telegram_utils import get_chat_name, get_message_count
 
 if TYPE_CHECKING:
     from telegram_logger.database import Database
+    from telegram_logger.database_writer import DatabaseWriter
+
+
+DEFAULT_BATCH_SIZE = 500
+RENDER_DAYS_PER_TASK = 90
 
 
 def get_file_name(log_name, log_date):
     return f"irclogs/{log_date.year}/{log_name}.{log_date.strftime('%m-%d')}.log"
 
 
+@contextmanager
+def open_log_file(file_name: str, compress: bool):
+    # Written to a temporary file and renamed into place, so pisg never sees a half written log. The temporary file
+    # is hidden, so the cfg's Logfile glob does not match it, and removed if writing fails. Whichever of the plain
+    # and gzipped versions is not being written is removed, so pisg does not read the day twice.
+    final_name, stale_name = (f"{file_name}.gz", file_name) if compress else (file_name, f"{file_name}.gz")
+    temp_file_name = os.path.join(os.path.dirname(final_name), f".{os.path.basename(final_name)}.tmp")
+    try:
+        if compress:
+            # No file name or timestamp in the gzip header, so identical logs give identical files
+            with open(temp_file_name, "wb") as raw_file:
+                with gzip.GzipFile(filename="", mode="wb", fileobj=raw_file, mtime=0) as gzip_file:
+                    with io.TextIOWrapper(gzip_file, encoding="utf-8") as f:
+                        yield f
+        else:
+            with open(temp_file_name, "w", encoding="utf-8") as f:
+                yield f
+        os.replace(temp_file_name, final_name)
+    except BaseException:
+        if os.path.exists(temp_file_name):
+            os.remove(temp_file_name)
+        raise
+    if os.path.exists(stale_name):
+        os.remove(stale_name)
+
+
+class UnknownUserError(Exception):
+    pass
+
+
 class ChatLog:
 
     def __init__(self, handle: str, db: "Database", last_message_id: Optional[int] = None):
         self.handle = handle
         self.db = db
         self.last_message_id = last_message_id
+        self._scrape_started = False
+        self._pending_entries = []
+        self._pending_message_count = 0
+        self._pending_last_message_id = None
+        self._pending_fetched_ranges = []  # type: List[Tuple[int, int]]
+        # Message ID ranges still to fetch in the current scrape. None as the end means up to the newest message.
+        self._ranges_to_fetch = []  # type: List[Tuple[int, Optional[int]]]
 
-    def add_entries(self, log_entries: List["LogEntry"]):
-        if log_entries is None:
-            return
-        self.db.insert_log_entries(self.handle, log_entries)
+    @property
+    def pending_message_count(self) -> int:
+        return self._pending_message_count
+
+    def add_entries(self, log_entries: Optional[List["LogEntry"]], message_id: Optional[int] = None,
+                    batch_size: Optional[int] = 1):
+        # With a batch_size of None, entries are only written once flush_entries() is called
+        if log_entries is not None:
+            self._pending_entries.extend(log_entries)
+        if message_id is not None:
+            self._pending_message_count += 1
+            self._pending_last_message_id = message_id
+            self._add_fetched_range(message_id, message_id)
+        if batch_size is not None and self._batch_full(batch_size):
+            self.flush_entries()
 
-    async def scrape_messages(self, client):
+    def _add_fetched_range(self, start_id: int, end_id: int):
+        if self._pending_fetched_ranges and self._pending_fetched_ranges[-1][1] >= start_id - 1:
+            last_start, last_end = self._pending_fetched_ranges[-1]
+            self._pending_fetched_ranges[-1] = (min(last_start, start_id), max(last_end, end_id))
+        else:
+            self._pending_fetched_ranges.append((start_id, end_id))
+
+    def _batch_full(self, batch_size: int) -> bool:
+        return len(self._pending_entries) >= batch_size or self._pending_message_count >= batch_size
+
+    def take_pending_entries(self) -> Tuple[List["LogEntry"], Optional[int], List[Tuple[int, int]]]:
+        # Hands over the pending entries, the checkpoint they reach and the message ID ranges they cover, leaving
+        # nothing pending
+        pending = self._pending_entries, self._pending_last_message_id, self._pending_fetched_ranges
+        self._pending_entries = []
+        self._pending_message_count = 0
+        self._pending_last_message_id = None
+        self._pending_fetched_ranges = []
+        return pending
+
+    def flush_entries(self) -> List["LogEntry"]:
+        # Writes the pending entries and the checkpoint they reach in one transaction, and returns the entries
+        log_entries, last_message_id, fetched_ranges = self.take_pending_entries()
+        if not log_entries and last_message_id is None:
+            return []
+        self.db.insert_log_entries(self.handle, log_entries, last_message_id, fetched_ranges)
+        if last_message_id is not None:
+            self.last_message_id = last_message_id
+        return log_entries
+
+    async def _hand_off_entries(self, writer: "DatabaseWriter", checkpoint: bool):
+        log_entries, last_message_id, fetched_ranges = self.take_pending_entries()
+        if log_entries or fetched_ranges:
+            await writer.submit(self, log_entries, last_message_id if checkpoint else None, fetched_ranges)
+
+    async def scrape_messages(
+            self,
+            client,
+            bar: tqdm,
+            writer: "DatabaseWriter",
+            batch_size: int = DEFAULT_BATCH_SIZE
+    ):
+        # Messages are fetched oldest first from the stored high-water mark, with a checkpoint committed every batch,
+        # so an interrupted scrape (or one which hit a flood wait) carries on from where it stopped. Batches are
+        # written by the writer thread, so a retry starts after the last message fetched, rather than the last one
+        # written. Gaps in the fetched ranges below the high-water mark are then filled in.
         entity = await client.get_entity(self.handle)
-        count = await get_message_count(client, entity, self.last_message_id)
         chat_name = get_chat_name(entity)
-        latest_id = None
-        print(f"- Updating {chat_name} logs")
-        with tqdm(total=count) as bar:
-            async for message in client.iter_messages(entity):
-                if latest_id is None:
-                    latest_id = message.id
-                if self.last_message_id is not None and message.id <= self.last_message_id:
-                    print(f"- Caught up on {chat_name}")
-                    break
-                else:
-                    self.add_entries(LogEntry.entries_from_message(message, chat_name))
+        if not self._scrape_started:
+            count = await get_message_count(client, entity, self.last_message_id)
+            bar.write(f"- Updating {chat_name} logs")
+            bar.total += count
+            bar.refresh()
+            missing_ranges = self.db.list_missing_ranges(self.handle, self.last_message_id)
+            self._ranges_to_fetch = [((self.last_message_id or 0) + 1, None)] + missing_ranges
+            self._scrape_started = True
+        while self._ranges_to_fetch:
+            start_id, end_id = self._ranges_to_fetch[0]
+            if end_id is not None:
+                bar.write(f"- Filling gap in {chat_name} logs, message IDs {start_id} to {end_id}")
+            await self._scrape_range(client, entity, chat_name, bar, writer, batch_size, start_id, end_id)
+            self._ranges_to_fetch.pop(0)
+        bar.write(f"- Caught up on {chat_name}")
+        self._scrape_started = False
+
+    async def _scrape_range(
+            self,
+            client,
+            entity,
+            chat_name: str,
+            bar: tqdm,
+            writer: "DatabaseWriter",
+            batch_size: int,
+            start_id: int,
+            end_id: Optional[int]
+    ):
+        # Only the open-ended range moves the checkpoint. Everything from start_id to the latest message fetched
+        # counts as fetched, as deleted messages leave holes in the IDs.
+        checkpoint = end_id is None
+        completed = False
+        try:
+            async for message in client.iter_messages(
+                    entity,
+                    min_id=start_id - 1,
+                    max_id=0 if end_id is None else end_id + 1,
+                    reverse=True
+            ):
+                self.add_entries(LogEntry.entries_from_message(message, chat_name), message.id, batch_size=None)
+                self._add_fetched_range(start_id, message.id)
+                self._ranges_to_fetch[0] = (message.id + 1, end_id)
+                instrumentation.increment("messages_scraped")
                 bar.update(1)
-        self.last_message_id = latest_id
-        self.db.update_chat_log(self.handle, self.last_message_id)
+                if self._batch_full(batch_size):
+                    await self._hand_off_entries(writer, checkpoint)
+            completed = True
+        finally:
+            if completed and end_id is not None:
+                self._add_fetched_range(start_id, end_id)
+            await self._hand_off_entries(writer, checkpoint)
 
     @classmethod
     def load_from_database(cls, chat_handle: str, database: "Database") -> "ChatLog":
         return database.get_chat_log(chat_handle)
 
-    def write_log_files(self, user_id_lookup, chat_name):
-        for log_date in self.db.list_log_dates(self.handle):
-            file_contents = [
-                "--- Log opened " + log_date.strftime("%a %b %d 00:00:00 %Y"),
-                *[entry.to_log_line(user_id_lookup) for entry in self.db.list_log_entries(self.handle, log_date)]
-            ]
-            if log_date != datetime.date.today():
-                next_date = log_date + datetime.timedelta(days=1)
-                file_contents.append("--- Log closed " + next_date.strftime("%a %b %d 00:00:00 %Y"))
+    def write_log_files(self, user_id_lookup, chat_name, compress_closed_days: bool = False):
+        today = datetime.date.today()
+        written_dates = self.write_log_days(user_id_lookup, chat_name, today, compress_closed_days)
+        self.mark_log_days_written(written_dates, today)
+
+    def submit_log_files(
+            self,
+            executor: Executor,
+            user_id_lookup,
+            chat_name,
+            today: datetime.date,
+            compress_closed_days: bool = False
+    ) -> List[Future]:
+        # Splits the days needing rendering into date ranges, each rendered by a worker started with
+        # init_render_worker(), so it has its own connection
+        log_dates = self.db.list_dirty_log_dates(self.handle)
+        return [
+            executor.submit(
+                render_log_days,
+                self.handle,
+                user_id_lookup,
+                chat_name,
+                today,
+                compress_closed_days,
+                log_dates[chunk_start],
+                log_dates[min(chunk_start + RENDER_DAYS_PER_TASK, len(log_dates)) - 1]
+            )
+            for chunk_start in range(0, len(log_dates), RENDER_DAYS_PER_TASK)
+        ]
+
+    def write_log_days(
+            self,
+            user_id_lookup,
+            chat_name,
+            today: datetime.date,
+            compress_closed_days: bool = False,
+            start_date: Optional[datetime.date] = None,
+            end_date: Optional[datetime.date] = None
+    ) -> List[datetime.date]:
+        written_dates = []
+        log_days = self.db.iter_log_days(
+            self.handle, dirty_only=True, start_date=start_date, end_date=end_date, as_rows=True
+        )
+        for log_date, rows in log_days:
             os.makedirs(f"irclogs/{log_date.year}", exist_ok=True)
             file_name = get_file_name(chat_name, log_date)
-            with open(file_name, "w", encoding="utf-8") as f:
-                f.write("\n".join(file_contents))
+            # Closed days can be stored compressed, and are then left alone unless a late message makes them dirty
+            compress = compress_closed_days and log_date != today
+            try:
+                with open_log_file(file_name, compress) as f:
+                    f.write("--- Log opened " + log_date.strftime("%a %b %d 00:00:00 %Y"))
+                    for row in rows:
+                        if row.user_id not in user_id_lookup:
+                            raise UnknownUserError(row.user_id)
+                        f.write("\n" + LogEntry.log_line_from_row(row, user_id_lookup))
+                    if log_date != today:
+                        next_date = log_date + datetime.timedelta(days=1)
+                        f.write("\n--- Log closed " + next_date.strftime("%a %b %d 00:00:00 %Y"))
+            except UnknownUserError:
+                # Offline, days with a user whose name has never been looked up keep their existing file, and stay
+                # dirty until the name is known
+                instrumentation.increment("log_days_skipped")
+                continue
+            written_dates.append(log_date)
+        return written_dates
+
+    def append_log_lines(
+            self,
+            log_entries: List["LogEntry"],
+            user_id_lookup,
+            chat_name,
+            compress_closed_days: bool = False
+    ) -> None:
+        # Appends new entries to today's log file. If they belong to any other day, or today's file has not been
+        # started yet, the dirty days are rendered in full instead.
+        today = datetime.date.today()
+        file_name = get_file_name(chat_name, today)
+        if not os.path.exists(file_name) or any(entry.log_datetime.date() != today for entry in log_entries):
+            self.write_log_files(user_id_lookup, chat_name, compress_closed_days)
+            return
+        with open(file_name, "a", encoding="utf-8") as f:
+            for entry in sorted(log_entries, key=lambda e: (e.message_id, e.sub_message_id)):
+                f.write("\n" + entry.to_log_line(user_id_lookup))
+
+    def mark_uncompressed_days_dirty(self, chat_name, today: datetime.date) -> None:
+        # Closed days rendered before compress_closed_days was turned on are rendered again, to compress them
+        self.db.mark_log_dates_dirty(self.handle, [
+            log_date for log_date in self.db.list_log_dates(self.handle)
+            if log_date < today and os.path.exists(get_file_name(chat_name, log_date))
+        ])
+
+    def remove_log_files(self, chat_name) -> None:
+        # Removes the logs rendered under a previous name for the chat, in either format
+        for log_date in self.db.list_log_dates(self.handle):
+            file_name = get_file_name(chat_name, log_date)
+            for old_file_name in [file_name, f"{file_name}.gz"]:
+                if os.path.exists(old_file_name):
+                    os.remove(old_file_name)
+
+    def mark_log_days_written(self, log_dates: List[datetime.date], today: datetime.date):
+        instrumentation.increment("log_days_written", len(log_dates))
+        # Days which are still open stay dirty, so they get their "Log closed" line once they are over
+        self.db.clear_dirty_log_dates(self.handle, [log_date for log_date in log_dates if log_date < today])
+
+
+_worker_database = None  # type: Optional["Database"]
+
+
+def init_render_worker(db_str: str) -> None:
+    # Run once in each render worker process, which then renders every task it is given from one connection. The
+    # connection is closed when the worker process exits.
+    global _worker_database
+    from telegram_logger.database import Database
+    _worker_database = Database(db_str)
+
+
+def render_log_days(
+        chat_handle: str,
+        user_id_lookup,
+        chat_name,
+        today: datetime.date,
+        compress_closed_days: bool,
+        start_date: datetime.date,
+        end_date: datetime.date
+) -> List[datetime.date]:
+    chat_log = ChatLog(chat_handle, _worker_database)
+    return chat_log.write_log_days(user_id_lookup, chat_name, today, compress_closed_days, start_date, end_date)
@@ -1,24 +1,34 @@
+import asyncio
+import datetime
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional, List, Set, TYPE_CHECKING
 
 from tqdm import tqdm
 
-from telegram_logger.chat_log import ChatLog
-from telegram_logger.telegram_utils import get_chat_name, get_user_name, get_user_name_unique_deleted
+from telegram_logger.chat_log import ChatLog, DEFAULT_BATCH_SIZE, init_render_worker
+from telegram_logger.entity_cache import EntityCache
+from telegram_logger.instrumentation import instrumentation
+from telegram_logger.scrape_scheduler import ScrapeScheduler
 
 if TYPE_CHECKING:
     from telegram_logger.database import Database
 
 
+def get_user_pic_path(user_id: int) -> str:
+    return f"pisg_output/user_pics/{user_id}.png"
+
+
 class DataStore:
 
-    def __init__(self, db: "Database", chat_handles: Optional[List] = None, user_ids: Optional[Set] = None):
+    def __init__(self, db: "Database", chat_handles: Optional[List] = None):
         self.db = db
         self.chat_handles = chat_handles or []
-        self.user_ids = user_ids or set()
+        self.user_ids = set()  # type: Set[int]
         self.chat_logs = [ChatLog.load_from_database(chat_handle, self.db) for chat_handle in self.chat_handles]
         self.user_extra_data = {}
+        self.entity_cache = EntityCache(self.db)
 
     def add_chat(self, chat_handle):
         self.chat_handles.append(chat_handle)
@@ -29,7 +39,6 @@ class DataStore:
         with open("irclogs_cache/data_store.json", "w", encoding="utf-8") as f:
             json.dump({
                 "chat_handles": self.chat_handles,
-                "user_ids": list(self.user_ids),
                 "user_extra_data": self.user_extra_data
             }, f, indent=2)
 
@@ -39,50 +48,165 @@ class DataStore:
             with open("irclogs_cache/data_store.json", "r", encoding="utf-8") as f:
                 data = json.load(f)
             handles = data.get("chat_handles")
-            user_ids = set(data.get("user_ids", []))
             user_extra_data = data.get("user_extra_data", {})
         except FileNotFoundError:
             handles = []
-            user_ids = set()
             user_extra_data = {}
-        data_store = cls(db, handles, user_ids)
+        data_store = cls(db, handles)
         data_store.user_extra_data = user_extra_data
+        data_store.load_user_ids()
         return data_store
 
-    async def update_all_logs(self, client):
-        for chat_log in self.chat_logs:
-            await chat_log.scrape_messages(client)
-            for user_id in self.db.list_user_ids(chat_log.handle):
-                self.user_ids.add(user_id)
+    async def update_all_logs(self, client, concurrency: int = 4, batch_size: int = DEFAULT_BATCH_SIZE):
+        scheduler = ScrapeScheduler(client, concurrency, batch_size)
+        await scheduler.scrape_all(self.chat_logs)
+        self.load_user_ids()
+        # Names are looked up while online, so render and cfg can later run offline
+        await self.entity_cache.load_users(client, self.user_ids)
+        await self.entity_cache.load_chats(client, self.chat_handles)
+
+    def load_user_ids(self):
+        # Read from the participants table, which is kept up to date as entries are inserted
+        self.user_ids.update(self.db.list_user_ids(self.chat_handles))
 
-    async def write_all_logs(self, client):
+    async def write_all_logs(self, client, render_workers: int = 1, compress_closed_days: bool = False):
+        await self.entity_cache.load_users(client, self.user_ids)
+        await self.entity_cache.load_chats(client, self.chat_handles)
+        # Users and chats with no cached name keep the name their logs were last written with. Days with a user who
+        # has neither are skipped, as are chats with neither, until the name is looked up.
+        rendered_user_names = self.db.get_rendered_user_names()
+        cached_user_names = {user_id: self.entity_cache.unique_user_name(user_id) for user_id in self.user_ids}
+        renamed_users = {
+            user_id: user_name
+            for user_id, user_name in cached_user_names.items()
+            if user_name is not None and rendered_user_names.get(user_id) != user_name
+        }
         user_id_lookup = {
-            user_id: get_user_name_unique_deleted(await client.get_entity(user_id))
-            for user_id in self.user_ids
+            user_id: user_name if user_name is not None else rendered_user_names[user_id]
+            for user_id, user_name in cached_user_names.items()
+            if user_name is not None or user_id in rendered_user_names
+        }
+        self.db.mark_user_log_dates_dirty(set(renamed_users.keys()))
+        today = datetime.date.today()
+        # A renamed chat has every day rendered again under the new name, and the old name's files removed after
+        rendered_chat_names = self.db.get_rendered_chat_names()
+        cached_chat_names = {chat_log: self.entity_cache.chat_name(chat_log.handle) for chat_log in self.chat_logs}
+        renamed_chats = {
+            chat_log: chat_name
+            for chat_log, chat_name in cached_chat_names.items()
+            if chat_name is not None and rendered_chat_names.get(chat_log.handle) != chat_name
         }
-        for chat_log in tqdm(self.chat_logs):
-            chat_entity = await client.get_entity(chat_log.handle)
-            chat_name = get_chat_name(chat_entity)
-            chat_log.write_log_files(user_id_lookup, chat_name)
+        for chat_log in renamed_chats.keys():
+            self.db.mark_log_dates_dirty(chat_log.handle, self.db.list_log_dates(chat_log.handle))
+        chat_names = {
+            chat_log: chat_name if chat_name is not None else rendered_chat_names[chat_log.handle]
+            for chat_log, chat_name in cached_chat_names.items()
+            if chat_name is not None or chat_log.handle in rendered_chat_names
+        }
+        if compress_closed_days:
+            for chat_log, chat_name in chat_names.items():
+                chat_log.mark_uncompressed_days_dirty(chat_name, today)
+        if render_workers > 1 and self.db.in_memory:
+            print("- An in-memory database cannot be opened by other processes, so rendering in this process")
+            render_workers = 1
+        if render_workers <= 1:
+            for chat_log, chat_name in tqdm(chat_names.items()):
+                chat_log.write_log_files(user_id_lookup, chat_name, compress_closed_days)
+        else:
+            executor = ProcessPoolExecutor(render_workers, initializer=init_render_worker, initargs=(self.db.db_str,))
+            with executor:
+                submitted = [
+                    (chat_log, chat_log.submit_log_files(
+                        executor,
+                        user_id_lookup,
+                        chat_name,
+                        today,
+                        compress_closed_days
+                    ))
+                    for chat_log, chat_name in chat_names.items()
+                ]
+                written = [
+                    (chat_log, [log_date for future in futures for log_date in future.result()])
+                    for chat_log, futures in tqdm(submitted)
+                ]
+            # Only cleared once every worker has finished, as sqlite cannot delete while the workers are still reading
+            for chat_log, written_dates in written:
+                chat_log.mark_log_days_written(written_dates, today)
+        self.db.update_rendered_user_names(renamed_users)
+        for chat_log, chat_name in renamed_chats.items():
+            old_chat_name = rendered_chat_names.get(chat_log.handle)
+            if old_chat_name is not None:
+                chat_log.remove_log_files(old_chat_name)
+        self.db.update_rendered_chat_names({
+            chat_log.handle: chat_name for chat_log, chat_name in renamed_chats.items()
+        })
+
+    async def update_user_pics(self, client, concurrency: int = 8) -> Set[int]:
+        # Only downloads pictures which have changed since the last run, and returns the users which have one
+        if client is None:
+            # Offline, pictures already on disk are kept as they are, and nothing is downloaded or removed
+            return {user_id for user_id in self.user_ids if os.path.exists(get_user_pic_path(user_id))}
+        photos = self.db.get_user_photos(list(self.user_ids))
+        semaphore = asyncio.Semaphore(concurrency)
+        users_with_pics = set()
+        to_download = []
+        downloaded_photo_ids = {}
+        for user_id in self.user_ids:
+            photo = photos.get(user_id)
+            pic_path = get_user_pic_path(user_id)
+            if photo is None or photo.photo_id is None:
+                if os.path.exists(pic_path):
+                    os.remove(pic_path)
+                if photo is not None and photo.downloaded_photo_id is not None:
+                    downloaded_photo_ids[user_id] = None
+            elif photo.photo_id != photo.downloaded_photo_id or not os.path.exists(pic_path):
+                to_download.append(user_id)
+            else:
+                users_with_pics.add(user_id)
+
+        async def download_pic(user_id: int):
+            async with semaphore:
+                return user_id, await client.download_profile_photo(user_id, get_user_pic_path(user_id))
+
+        instrumentation.increment("photos_unchanged", len(users_with_pics))
+        with instrumentation.phase("photo_download"):
+            downloads = asyncio.as_completed([download_pic(user_id) for user_id in to_download])
+            for download in tqdm(downloads, total=len(to_download)):
+                user_id, pic = await download
+                instrumentation.increment("photos_downloaded")
+                if pic is None:
+                    downloaded_photo_ids[user_id] = None
+                else:
+                    downloaded_photo_ids[user_id] = photos[user_id].photo_id
+                    users_with_pics.add(user_id)
+        self.db.save_downloaded_photo_ids(downloaded_photo_ids)
+        return users_with_pics
 
-    async def write_users_cfg(self, client):
+    async def write_users_cfg(self, client, photo_concurrency: int = 8):
         users_cfg = []
         os.makedirs("pisg_output/user_pics/", exist_ok=True)
         deleted_account_count = 0
-        for user_id in tqdm(self.user_ids):
-            user_name = get_user_name(await client.get_entity(user_id))
-            pic = await client.download_profile_photo(user_id, f"pisg_output/user_pics/{user_id}.png")
+        await self.entity_cache.load_users(client, self.user_ids)
+        users_with_pics = await self.update_user_pics(client, photo_concurrency)
+        # Users with no cached name keep the name their logs were last written with, or are left out until looked up
+        rendered_user_names = self.db.get_rendered_user_names()
+        for user_id in self.user_ids:
+            user_name = self.entity_cache.user_name(user_id)
+            if user_name is None:
+                user_name = rendered_user_names.get(user_id)
+            if user_name is None:
+                continue
             user_data = self.user_extra_data.get(str(user_id), {})
             if user_name == "DELETED_ACCOUNT":
                 deleted_account_count += 1
                 if "alias" not in user_data:
-                    user_data["alias"] = get_user_name_unique_deleted(await client.get_entity(user_id))
+                    user_data["alias"] = self.entity_cache.unique_user_name(user_id)
                 if "nick" not in user_data:
                     user_data["nick"] = f"{user_name}{deleted_account_count}"
             else:
                 if "nick" not in user_data:
                     user_data["nick"] = user_name
-            if "pic" not in user_data and pic is not None:
+            if "pic" not in user_data and user_id in users_with_pics:
                 user_data["pic"] = f"user_pics/{user_id}.png"
             user_line = "<user " + " ".join(f"{key}=\"{value}\"" for key, value in user_data.items()) + ">"
             users_cfg.append(user_line)
@@ -92,12 +216,18 @@ class DataStore:
     async def write_channel_cfg(self, client):
         # Write channel config
         chats_cfg = []
+        await self.entity_cache.load_chats(client, self.chat_handles)
+        rendered_chat_names = self.db.get_rendered_chat_names()
         for chat_handle in self.chat_handles:
-            chat_name = get_chat_name(await client.get_entity(chat_handle))
+            chat_name = self.entity_cache.chat_name(chat_handle)
+            if chat_name is None:
+                chat_name = rendered_chat_names.get(chat_handle)
+            if chat_name is None:
+                continue
             clean_name = chat_name.replace(" ", r"\ ")
             chats_cfg.append(f"""
         <channel="{chat_name}">
-             Logfile = "irclogs/*/{clean_name}*.log"
+             Logfile = "irclogs/*/{clean_name}*.log*"
              OutputFile = "pisg_output/{chat_name}.html"
         </channel>""")
         with open("chats.cfg", "w", encoding="utf-8") as f:
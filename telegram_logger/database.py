@@ -1,16 +1,40 @@
+import collections
 import datetime
-from typing import List, Optional, Set
+import itertools
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
 
 from telegram_logger.chat_log import ChatLog
+from telegram_logger.instrumentation import instrumentation
 from telegram_logger.log_entry import LogEntry
 
+STAT_COLUMNS = ["messages", "lines", "joins", "quits"]
+
 
 class Database:
+    QUERY_CHUNK_SIZE = 500
+    EXPORT_CHUNK_SIZE = 1000
+    MIGRATION_CHUNK_SIZE = 50000
+
     def __init__(self, db_str: str) -> None:
-        self.engine = sqlalchemy.create_engine(db_str)
-        self.conn = self.engine.connect()
+        self.db_str = db_str
+        url = sqlalchemy.engine.make_url(db_str)
+        self.in_memory = url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+        if self.in_memory:
+            # An in-memory sqlite database only exists within its one connection, so every thread has to share it
+            self.engine = sqlalchemy.create_engine(
+                db_str,
+                poolclass=sqlalchemy.pool.StaticPool,
+                connect_args={"check_same_thread": False}
+            )
+        else:
+            self.engine = sqlalchemy.create_engine(db_str)
+        instrumentation.attach_engine(self.engine)
+        # Each thread gets its own connection, as the scrape pipeline writes from a background thread
+        self._local = threading.local()
         self.metadata = sqlalchemy.MetaData()
         self.chat_logs = sqlalchemy.Table(
             "telepisg_chat_logs",
@@ -36,37 +60,735 @@ class Database:
             sqlalchemy.Column("message_id", sqlalchemy.BigInteger()),
             sqlalchemy.Column("sub_message_id", sqlalchemy.Integer()),
             sqlalchemy.Column("text", sqlalchemy.Text()),
-            sqlalchemy.UniqueConstraint("chat_handle", "message_id", "sub_message_id")
+            sqlalchemy.Column("log_date", sqlalchemy.Date()),
+            sqlalchemy.UniqueConstraint("chat_handle", "message_id", "sub_message_id"),
+            sqlalchemy.Index("ix_telepisg_log_entries_chat_date", "chat_handle", "log_date", "message_id"),
+            sqlalchemy.Index("ix_telepisg_log_entries_chat_user", "chat_handle", "user_id")
+        )
+        self.dirty_log_dates = sqlalchemy.Table(
+            "telepisg_dirty_log_dates",
+            self.metadata,
+            sqlalchemy.Column(
+                "chat_handle",
+                sqlalchemy.String(),
+                sqlalchemy.ForeignKey(
+                    "telepisg_chat_logs.chat_handle",
+                    ondelete="CASCADE"
+                ),
+                nullable=False,
+                primary_key=True
+            ),
+            sqlalchemy.Column("log_date", sqlalchemy.Date(), nullable=False, primary_key=True)
+        )
+        self.rendered_user_names = sqlalchemy.Table(
+            "telepisg_rendered_user_names",
+            self.metadata,
+            sqlalchemy.Column("user_id", sqlalchemy.BigInteger(), nullable=False, primary_key=True),
+            sqlalchemy.Column("user_name", sqlalchemy.String(), nullable=False)
+        )
+        self.rendered_chat_names = sqlalchemy.Table(
+            "telepisg_rendered_chat_names",
+            self.metadata,
+            sqlalchemy.Column(
+                "chat_handle",
+                sqlalchemy.String(),
+                sqlalchemy.ForeignKey(
+                    "telepisg_chat_logs.chat_handle",
+                    ondelete="CASCADE"
+                ),
+                nullable=False,
+                primary_key=True
+            ),
+            sqlalchemy.Column("chat_name", sqlalchemy.String(), nullable=False)
+        )
+        self.entities = sqlalchemy.Table(
+            "telepisg_entities",
+            self.metadata,
+            sqlalchemy.Column("entity_type", sqlalchemy.String(), nullable=False, primary_key=True),
+            sqlalchemy.Column("entity_key", sqlalchemy.String(), nullable=False, primary_key=True),
+            sqlalchemy.Column("name", sqlalchemy.String(), nullable=False),
+            sqlalchemy.Column("unique_name", sqlalchemy.String(), nullable=False),
+            sqlalchemy.Column("updated_at", sqlalchemy.DateTime(), nullable=False)
+        )
+        self.user_photos = sqlalchemy.Table(
+            "telepisg_user_photos",
+            self.metadata,
+            sqlalchemy.Column("user_id", sqlalchemy.BigInteger(), nullable=False, primary_key=True),
+            sqlalchemy.Column("photo_id", sqlalchemy.BigInteger()),
+            sqlalchemy.Column("downloaded_photo_id", sqlalchemy.BigInteger())
+        )
+        self.daily_user_stats = sqlalchemy.Table(
+            "telepisg_daily_user_stats",
+            self.metadata,
+            sqlalchemy.Column(
+                "chat_handle",
+                sqlalchemy.String(),
+                sqlalchemy.ForeignKey(
+                    "telepisg_chat_logs.chat_handle",
+                    ondelete="CASCADE"
+                ),
+                nullable=False,
+                primary_key=True
+            ),
+            sqlalchemy.Column("log_date", sqlalchemy.Date(), nullable=False, primary_key=True),
+            sqlalchemy.Column("user_id", sqlalchemy.BigInteger(), nullable=False, primary_key=True),
+            sqlalchemy.Column("messages", sqlalchemy.Integer(), nullable=False, default=0),
+            sqlalchemy.Column("lines", sqlalchemy.Integer(), nullable=False, default=0),
+            sqlalchemy.Column("joins", sqlalchemy.Integer(), nullable=False, default=0),
+            sqlalchemy.Column("quits", sqlalchemy.Integer(), nullable=False, default=0)
+        )
+        self.hourly_stats = sqlalchemy.Table(
+            "telepisg_hourly_stats",
+            self.metadata,
+            sqlalchemy.Column(
+                "chat_handle",
+                sqlalchemy.String(),
+                sqlalchemy.ForeignKey(
+                    "telepisg_chat_logs.chat_handle",
+                    ondelete="CASCADE"
+                ),
+                nullable=False,
+                primary_key=True
+            ),
+            sqlalchemy.Column("hour", sqlalchemy.Integer(), nullable=False, primary_key=True),
+            sqlalchemy.Column("messages", sqlalchemy.Integer(), nullable=False, default=0),
+            sqlalchemy.Column("lines", sqlalchemy.Integer(), nullable=False, default=0),
+            sqlalchemy.Column("joins", sqlalchemy.Integer(), nullable=False, default=0),
+            sqlalchemy.Column("quits", sqlalchemy.Integer(), nullable=False, default=0)
+        )
+        self.participants = sqlalchemy.Table(
+            "telepisg_participants",
+            self.metadata,
+            sqlalchemy.Column(
+                "chat_handle",
+                sqlalchemy.String(),
+                sqlalchemy.ForeignKey(
+                    "telepisg_chat_logs.chat_handle",
+                    ondelete="CASCADE"
+                ),
+                nullable=False,
+                primary_key=True
+            ),
+            sqlalchemy.Column("user_id", sqlalchemy.BigInteger(), nullable=False, primary_key=True),
+            sqlalchemy.Column("first_seen", sqlalchemy.DateTime(), nullable=False),
+            sqlalchemy.Column("last_seen", sqlalchemy.DateTime(), nullable=False),
+            sqlalchemy.Column("message_count", sqlalchemy.Integer(), nullable=False, default=0)
+        )
+        # Ranges of message IDs which have been fetched, so gaps in a chat's history can be found and filled
+        self.fetched_ranges = sqlalchemy.Table(
+            "telepisg_fetched_ranges",
+            self.metadata,
+            sqlalchemy.Column(
+                "chat_handle",
+                sqlalchemy.String(),
+                sqlalchemy.ForeignKey(
+                    "telepisg_chat_logs.chat_handle",
+                    ondelete="CASCADE"
+                ),
+                nullable=False,
+                primary_key=True
+            ),
+            sqlalchemy.Column("start_message_id", sqlalchemy.BigInteger(), nullable=False, primary_key=True),
+            sqlalchemy.Column("end_message_id", sqlalchemy.BigInteger(), nullable=False)
         )
+        self.schema_version = sqlalchemy.Table(
+            "telepisg_schema_version",
+            self.metadata,
+            sqlalchemy.Column("version", sqlalchemy.Integer(), nullable=False)
+        )
+        self.migrations = [
+            self._migrate_add_log_date,
+            self._migrate_seed_fetched_ranges,
+            self._migrate_add_participants,
+            self._migrate_merge_message_lines,
+            self._migrate_rebuild_stats
+        ]
+        existing_database = sqlalchemy.inspect(self.engine).has_table(self.log_entries.name)
         self.metadata.create_all(self.engine)
+        self.migrate(existing_database)
+
+    @property
+    def conn(self) -> sqlalchemy.engine.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.engine.connect()
+            self._local.conn = conn
+        return conn
+
+    def close_thread_connection(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def close(self) -> None:
+        self.close_thread_connection()
+        self.engine.dispose()
+
+    def _dialect_insert(self, table: sqlalchemy.Table):
+        if self.engine.dialect.name == "postgresql":
+            return postgresql.insert(table)
+        return sqlite.insert(table)
+
+    def get_schema_version(self) -> Optional[int]:
+        query = sqlalchemy.select([self.schema_version.columns.version])
+        return self.conn.execute(query).scalar()
+
+    def set_schema_version(self, version: int) -> None:
+        self.conn.execute(sqlalchemy.delete(self.schema_version))
+        self.conn.execute(sqlalchemy.insert(self.schema_version).values(version=version))
+
+    def migrate(self, existing_database: bool) -> None:
+        # Each migration brings the schema up to the version matching its position in the list. A fresh database
+        # is created at the latest schema by create_all, so only needs its version recording.
+        version = self.get_schema_version()
+        if version is None:
+            version = 0 if existing_database else len(self.migrations)
+            self.set_schema_version(version)
+        for new_version, migration in enumerate(self.migrations[version:], start=version + 1):
+            print(f"- Migrating database to schema version {new_version}")
+            migration()
+            self.set_schema_version(new_version)
+
+    def _migrate_add_log_date(self) -> None:
+        # Safe to run again if it was interrupted part way, each step checks whether it is already done
+        inspector = sqlalchemy.inspect(self.engine)
+        column_names = [column["name"] for column in inspector.get_columns(self.log_entries.name)]
+        if "log_date" not in column_names:
+            self.conn.execute(sqlalchemy.text("ALTER TABLE telepisg_log_entries ADD COLUMN log_date DATE"))
+        if self.engine.url.drivername == "sqlite":
+            log_date_expression = sqlalchemy.func.DATE(self.log_entries.columns.datetime)
+        else:
+            log_date_expression = sqlalchemy.cast(self.log_entries.columns.datetime, sqlalchemy.Date)
+        # Backfilled in ranges of message IDs, each in its own transaction, so large databases are not locked for long
+        for chat_handle in self.list_chat_handles():
+            query = sqlalchemy.select(
+                [
+                    sqlalchemy.func.min(self.log_entries.columns.message_id).label("min_id"),
+                    sqlalchemy.func.max(self.log_entries.columns.message_id).label("max_id")
+                ]
+            ).where(
+                self.log_entries.columns.chat_handle == chat_handle
+            )
+            id_range = self.conn.execute(query).fetchone()
+            if id_range.min_id is None:
+                continue
+            for chunk_start in range(id_range.min_id, id_range.max_id + 1, self.MIGRATION_CHUNK_SIZE):
+                query = sqlalchemy.update(
+                    self.log_entries
+                ).values(
+                    log_date=log_date_expression
+                ).where(
+                    sqlalchemy.and_(
+                        self.log_entries.columns.chat_handle == chat_handle,
+                        self.log_entries.columns.message_id >= chunk_start,
+                        self.log_entries.columns.message_id < chunk_start + self.MIGRATION_CHUNK_SIZE,
+                        self.log_entries.columns.log_date.is_(None)
+                    )
+                )
+                with self.conn.begin():
+                    self.conn.execute(query)
+        index_names = [index["name"] for index in sqlalchemy.inspect(self.engine).get_indexes(self.log_entries.name)]
+        for index in self.log_entries.indexes:
+            if index.name not in index_names:
+                index.create(self.conn)
+
+    def _migrate_seed_fetched_ranges(self) -> None:
+        # Chats were always scraped from the start up to their high-water mark, so that range counts as fetched
+        query = sqlalchemy.select(
+            [self.chat_logs.columns.chat_handle, self.chat_logs.columns.last_message_id]
+        ).where(
+            self.chat_logs.columns.last_message_id.isnot(None)
+        )
+        rows = self.conn.execute(query).fetchall()
+        with self.conn.begin():
+            for row in rows:
+                self.add_fetched_ranges(row.chat_handle, [(1, row.last_message_id)])
+
+    def _migrate_add_participants(self) -> None:
+        for chat_handle in self.list_chat_handles():
+            with self.conn.begin():
+                self._rebuild_participants(chat_handle)
+
+    def _migrate_merge_message_lines(self) -> None:
+        # Multi-line messages used to be stored as a row per line, with sub_message_id 0 holding the last line. Each
+        # is merged back into its sub_message_id 0 row, in ranges of message IDs, each in its own transaction.
+        columns = self.log_entries.columns
+        for chat_handle in self.list_chat_handles():
+            query = sqlalchemy.select(
+                [
+                    sqlalchemy.func.min(columns.message_id).label("min_id"),
+                    sqlalchemy.func.max(columns.message_id).label("max_id")
+                ]
+            ).where(
+                sqlalchemy.and_(
+                    columns.chat_handle == chat_handle,
+                    columns.sub_message_id > 0
+                )
+            )
+            id_range = self.conn.execute(query).fetchone()
+            if id_range.min_id is None:
+                continue
+            for chunk_start in range(id_range.min_id, id_range.max_id + 1, self.MIGRATION_CHUNK_SIZE):
+                in_chunk = sqlalchemy.and_(
+                    columns.chat_handle == chat_handle,
+                    columns.message_id >= chunk_start,
+                    columns.message_id < chunk_start + self.MIGRATION_CHUNK_SIZE
+                )
+                multi_line_ids = sqlalchemy.select(
+                    columns.message_id
+                ).where(
+                    sqlalchemy.and_(in_chunk, columns.sub_message_id > 0)
+                )
+                query = sqlalchemy.select(
+                    [columns.message_id, columns.text]
+                ).where(
+                    sqlalchemy.and_(in_chunk, columns.message_id.in_(multi_line_ids))
+                ).order_by(
+                    sqlalchemy.asc(columns.message_id),
+                    sqlalchemy.desc(columns.sub_message_id)
+                )
+                with self.conn.begin():
+                    rows = self.conn.execute(query).fetchall()
+                    merged_texts = [
+                        {"merged_message_id": message_id, "merged_text": "\n".join(row.text for row in message_rows)}
+                        for message_id, message_rows in itertools.groupby(rows, key=lambda row: row.message_id)
+                    ]
+                    update = sqlalchemy.update(
+                        self.log_entries
+                    ).where(
+                        sqlalchemy.and_(
+                            columns.chat_handle == chat_handle,
+                            columns.message_id == sqlalchemy.bindparam("merged_message_id"),
+                            columns.sub_message_id == 0
+                        )
+                    ).values(
+                        text=sqlalchemy.bindparam("merged_text")
+                    )
+                    self.conn.execute(update, merged_texts)
+                    self.conn.execute(sqlalchemy.delete(self.log_entries).where(
+                        sqlalchemy.and_(in_chunk, columns.sub_message_id > 0)
+                    ))
+
+    def _migrate_rebuild_stats(self) -> None:
+        # Chats scraped before the rollups existed have none, so every chat's rollups are calculated from its logs
+        for chat_handle in self.list_chat_handles():
+            self.rebuild_stats(chat_handle)
+
+    def _insert_ignoring_conflicts(self, table: sqlalchemy.Table, rows: List[Dict]) -> None:
+        if not rows:
+            return
+        query = self._dialect_insert(table).on_conflict_do_nothing()
+        self.conn.execute(query, rows)
+
+    def insert_log_entries(
+            self,
+            chat_handle: str,
+            log_entries: List["LogEntry"],
+            last_message_id: Optional[int] = None,
+            fetched_ranges: Optional[List[Tuple[int, int]]] = None
+    ):
+        # Entries which are already stored are skipped, so overlapping fetches are harmless
+        with self.conn.begin():
+            log_entries = self._filter_new_log_entries(chat_handle, log_entries)
+            values_list = [
+                log_entry.to_row(chat_handle) for log_entry in log_entries
+            ]
+            self._insert_ignoring_conflicts(self.log_entries, values_list)
+            instrumentation.increment("log_entries_inserted", len(values_list))
+            self.mark_log_dates_dirty(chat_handle, {log_entry.log_datetime.date() for log_entry in log_entries})
+            self._add_to_stats(chat_handle, log_entries)
+            self._add_to_participants(chat_handle, log_entries)
+            if last_message_id is not None:
+                self.update_chat_log(chat_handle, last_message_id)
+            if fetched_ranges:
+                self.add_fetched_ranges(chat_handle, fetched_ranges)
+
+    def _filter_new_log_entries(self, chat_handle: str, log_entries: List["LogEntry"]) -> List["LogEntry"]:
+        message_ids = list({log_entry.message_id for log_entry in log_entries})
+        existing = set()
+        for chunk_start in range(0, len(message_ids), self.QUERY_CHUNK_SIZE):
+            query = sqlalchemy.select(
+                [self.log_entries.columns.message_id, self.log_entries.columns.sub_message_id]
+            ).where(
+                sqlalchemy.and_(
+                    self.log_entries.columns.chat_handle == chat_handle,
+                    self.log_entries.columns.message_id.in_(
+                        message_ids[chunk_start:chunk_start + self.QUERY_CHUNK_SIZE]
+                    )
+                )
+            )
+            result = self.conn.execute(query)
+            existing.update((row.message_id, row.sub_message_id) for row in result.fetchall())
+        return [
+            log_entry for log_entry in log_entries
+            if (log_entry.message_id, log_entry.sub_message_id) not in existing
+        ]
+
+    def _add_to_stats(self, chat_handle: str, log_entries: List["LogEntry"]) -> None:
+        daily_counts = collections.defaultdict(collections.Counter)
+        hourly_counts = collections.defaultdict(collections.Counter)
+        for log_entry in log_entries:
+            day_key = (log_entry.log_datetime.date(), log_entry.user_id)
+            hour_key = log_entry.log_datetime.hour
+            for counts in [daily_counts[day_key], hourly_counts[hour_key]]:
+                if log_entry.log_type == LogEntry.TYPE_JOIN:
+                    counts["joins"] += 1
+                elif log_entry.log_type == LogEntry.TYPE_QUIT:
+                    counts["quits"] += 1
+                else:
+                    # A multi-line message is a single entry, which renders as a log line per line of text
+                    counts["lines"] += log_entry.text.count("\n") + 1
+                    if log_entry.sub_message_id == 0:
+                        counts["messages"] += 1
+        self._increment_stats(self.daily_user_stats, ["chat_handle", "log_date", "user_id"], [
+            {"chat_handle": chat_handle, "log_date": log_date, "user_id": user_id, **self._stat_values(counts)}
+            for (log_date, user_id), counts in daily_counts.items()
+        ])
+        self._increment_stats(self.hourly_stats, ["chat_handle", "hour"], [
+            {"chat_handle": chat_handle, "hour": hour, **self._stat_values(counts)}
+            for hour, counts in hourly_counts.items()
+        ])
+
+    def _add_to_participants(self, chat_handle: str, log_entries: List["LogEntry"]) -> None:
+        participants = {}
+        for log_entry in log_entries:
+            if log_entry.user_id is None:
+                continue
+            participant = participants.get(log_entry.user_id)
+            if participant is None:
+                participant = participants[log_entry.user_id] = {
+                    "chat_handle": chat_handle,
+                    "user_id": log_entry.user_id,
+                    "first_seen": log_entry.log_datetime,
+                    "last_seen": log_entry.log_datetime,
+                    "message_count": 0
+                }
+            participant["first_seen"] = min(participant["first_seen"], log_entry.log_datetime)
+            participant["last_seen"] = max(participant["last_seen"], log_entry.log_datetime)
+            # Every message has exactly one sub_message_id 0 entry
+            if log_entry.sub_message_id == 0:
+                participant["message_count"] += 1
+        if not participants:
+            return
+        columns = self.participants.columns
+        query = self._dialect_insert(self.participants)
+        query = query.on_conflict_do_update(
+            index_elements=[columns.chat_handle, columns.user_id],
+            set_={
+                "first_seen": sqlalchemy.case(
+                    (query.excluded.first_seen < columns.first_seen, query.excluded.first_seen),
+                    else_=columns.first_seen
+                ),
+                "last_seen": sqlalchemy.case(
+                    (query.excluded.last_seen > columns.last_seen, query.excluded.last_seen),
+                    else_=columns.last_seen
+                ),
+                "message_count": columns.message_count + query.excluded.message_count
+            }
+        )
+        self.conn.execute(query, list(participants.values()))
+
+    def _rebuild_participants(self, chat_handle: str) -> None:
+        self.conn.execute(sqlalchemy.delete(self.participants).where(
+            self.participants.columns.chat_handle == chat_handle
+        ))
+        query = sqlalchemy.select(
+            [
+                self.log_entries.columns.chat_handle,
+                self.log_entries.columns.user_id,
+                sqlalchemy.func.min(self.log_entries.columns.datetime),
+                sqlalchemy.func.max(self.log_entries.columns.datetime),
+                sqlalchemy.func.count(sqlalchemy.distinct(self.log_entries.columns.message_id))
+            ]
+        ).where(
+            sqlalchemy.and_(
+                self.log_entries.columns.chat_handle == chat_handle,
+                self.log_entries.columns.user_id.isnot(None)
+            )
+        ).group_by(
+            self.log_entries.columns.chat_handle,
+            self.log_entries.columns.user_id
+        )
+        self.conn.execute(sqlalchemy.insert(self.participants).from_select(
+            ["chat_handle", "user_id", "first_seen", "last_seen", "message_count"],
+            query
+        ))
 
-    def insert_log_entries(self, chat_handle: str, log_entries: List["LogEntry"]):
-        query = sqlalchemy.insert(self.log_entries)
-        values_list = [
-            log_entry.to_row(chat_handle) for log_entry in log_entries
+    @staticmethod
+    def _stat_values(counts: collections.Counter) -> Dict[str, int]:
+        return {stat: counts[stat] for stat in STAT_COLUMNS}
+
+    def _increment_stats(self, table: sqlalchemy.Table, key_columns: List[str], rows: List[Dict]) -> None:
+        if not rows:
+            return
+        query = self._dialect_insert(table)
+        query = query.on_conflict_do_update(
+            index_elements=[table.columns[column] for column in key_columns],
+            set_={stat: table.columns[stat] + query.excluded[stat] for stat in STAT_COLUMNS}
+        )
+        self.conn.execute(query, rows)
+
+    def rebuild_stats(self, chat_handle: str) -> None:
+        # Recalculates a chat's rollups and participants from its log entries, for data stored before they existed
+        entry_type = self.log_entries.columns.entry_type
+        text = self.log_entries.columns.text
+        line_count = sqlalchemy.func.length(text) - sqlalchemy.func.length(sqlalchemy.func.replace(text, "\n", "")) + 1
+        stat_cols = [
+            sqlalchemy.func.count(sqlalchemy.distinct(sqlalchemy.case(
+                (entry_type.in_([LogEntry.TYPE_TEXT, LogEntry.TYPE_ACTION]), self.log_entries.columns.message_id)
+            ))).label("messages"),
+            sqlalchemy.func.sum(sqlalchemy.case(
+                (entry_type.in_([LogEntry.TYPE_TEXT, LogEntry.TYPE_ACTION]), line_count), else_=0
+            )).label("lines"),
+            sqlalchemy.func.sum(sqlalchemy.case((entry_type == LogEntry.TYPE_JOIN, 1), else_=0)).label("joins"),
+            sqlalchemy.func.sum(sqlalchemy.case((entry_type == LogEntry.TYPE_QUIT, 1), else_=0)).label("quits")
         ]
-        self.conn.execute(query, values_list)
+        log_date_col = self.log_entries.columns.log_date
+        hour_col = sqlalchemy.extract("hour", self.log_entries.columns.datetime)
+        with self.conn.begin():
+            self._rebuild_participants(chat_handle)
+            for table in [self.daily_user_stats, self.hourly_stats]:
+                self.conn.execute(sqlalchemy.delete(table).where(table.columns.chat_handle == chat_handle))
+            for table, key_cols in [
+                (self.daily_user_stats, {"log_date": log_date_col, "user_id": self.log_entries.columns.user_id}),
+                (self.hourly_stats, {"hour": hour_col})
+            ]:
+                query = sqlalchemy.select(
+                    [*[col.label(name) for name, col in key_cols.items()], *stat_cols]
+                ).where(
+                    self.log_entries.columns.chat_handle == chat_handle
+                ).group_by(
+                    *key_cols.values()
+                )
+                rows = self.conn.execute(query).fetchall()
+                if rows:
+                    self.conn.execute(sqlalchemy.insert(table), [
+                        {"chat_handle": chat_handle, **row._mapping} for row in rows
+                    ])
+
+    def get_daily_stats(self, chat_handle: str, user_id: Optional[int] = None) -> List[sqlalchemy.engine.Row]:
+        conditions = [self.daily_user_stats.columns.chat_handle == chat_handle]
+        if user_id is not None:
+            conditions.append(self.daily_user_stats.columns.user_id == user_id)
+        query = sqlalchemy.select(
+            [
+                self.daily_user_stats.columns.log_date,
+                *[sqlalchemy.func.sum(self.daily_user_stats.columns[stat]).label(stat) for stat in STAT_COLUMNS]
+            ]
+        ).where(
+            sqlalchemy.and_(*conditions)
+        ).group_by(
+            self.daily_user_stats.columns.log_date
+        ).order_by(
+            sqlalchemy.asc(self.daily_user_stats.columns.log_date)
+        )
+        return self.conn.execute(query).fetchall()
+
+    def get_user_stats(self, chat_handle: str) -> List[sqlalchemy.engine.Row]:
+        query = sqlalchemy.select(
+            [
+                self.daily_user_stats.columns.user_id,
+                *[sqlalchemy.func.sum(self.daily_user_stats.columns[stat]).label(stat) for stat in STAT_COLUMNS]
+            ]
+        ).where(
+            self.daily_user_stats.columns.chat_handle == chat_handle
+        ).group_by(
+            self.daily_user_stats.columns.user_id
+        ).order_by(
+            sqlalchemy.desc("lines")
+        )
+        return self.conn.execute(query).fetchall()
+
+    def get_hourly_stats(self, chat_handle: str) -> List[sqlalchemy.engine.Row]:
+        query = sqlalchemy.select(
+            [
+                self.hourly_stats.columns.hour,
+                *[self.hourly_stats.columns[stat] for stat in STAT_COLUMNS]
+            ]
+        ).where(
+            self.hourly_stats.columns.chat_handle == chat_handle
+        ).order_by(
+            sqlalchemy.asc(self.hourly_stats.columns.hour)
+        )
+        return self.conn.execute(query).fetchall()
+
+    def mark_log_dates_dirty(self, chat_handle: str, log_dates: Iterable[datetime.date]) -> None:
+        self._insert_ignoring_conflicts(self.dirty_log_dates, [
+            {"chat_handle": chat_handle, "log_date": log_date} for log_date in log_dates
+        ])
+
+    def mark_user_log_dates_dirty(self, user_ids: Set[int]) -> None:
+        if not user_ids:
+            return
+        # Queried a chat and a chunk of users at a time, so the chat and user index is used and the IN list stays short
+        user_ids = sorted(user_ids)
+        for chat_handle in self.list_chat_handles():
+            for chunk_start in range(0, len(user_ids), self.QUERY_CHUNK_SIZE):
+                query = sqlalchemy.select(
+                    [self.log_entries.columns.log_date]
+                ).distinct(
+                ).where(
+                    sqlalchemy.and_(
+                        self.log_entries.columns.chat_handle == chat_handle,
+                        self.log_entries.columns.user_id.in_(
+                            user_ids[chunk_start:chunk_start + self.QUERY_CHUNK_SIZE]
+                        )
+                    )
+                )
+                result = self.conn.execute(query)
+                self.mark_log_dates_dirty(chat_handle, [row.log_date for row in result.fetchall()])
+
+    def list_dirty_log_dates(self, chat_handle: str) -> List[datetime.date]:
+        query = sqlalchemy.select(
+            [self.dirty_log_dates.columns.log_date]
+        ).where(
+            self.dirty_log_dates.columns.chat_handle == chat_handle
+        ).order_by(
+            sqlalchemy.asc(self.dirty_log_dates.columns.log_date)
+        )
+        result = self.conn.execute(query)
+        return [row.log_date for row in result.fetchall()]
+
+    def clear_dirty_log_dates(self, chat_handle: str, log_dates: List[datetime.date]) -> None:
+        for chunk_start in range(0, len(log_dates), self.QUERY_CHUNK_SIZE):
+            query = sqlalchemy.delete(
+                self.dirty_log_dates
+            ).where(
+                sqlalchemy.and_(
+                    self.dirty_log_dates.columns.chat_handle == chat_handle,
+                    self.dirty_log_dates.columns.log_date.in_(
+                        log_dates[chunk_start:chunk_start + self.QUERY_CHUNK_SIZE]
+                    )
+                )
+            )
+            self.conn.execute(query)
+
+    def get_rendered_user_names(self) -> Dict[int, str]:
+        query = sqlalchemy.select(self.rendered_user_names.columns)
+        result = self.conn.execute(query)
+        return {row.user_id: row.user_name for row in result.fetchall()}
+
+    def update_rendered_user_names(self, user_names: Dict[int, str]) -> None:
+        if not user_names:
+            return
+        query = self._dialect_insert(self.rendered_user_names)
+        query = query.on_conflict_do_update(
+            index_elements=[self.rendered_user_names.columns.user_id],
+            set_={"user_name": query.excluded.user_name}
+        )
+        self.conn.execute(query, [
+            {"user_id": user_id, "user_name": user_name} for user_id, user_name in user_names.items()
+        ])
+
+    def get_rendered_chat_names(self) -> Dict[str, str]:
+        query = sqlalchemy.select(self.rendered_chat_names.columns)
+        result = self.conn.execute(query)
+        return {row.chat_handle: row.chat_name for row in result.fetchall()}
+
+    def update_rendered_chat_names(self, chat_names: Dict[str, str]) -> None:
+        if not chat_names:
+            return
+        query = self._dialect_insert(self.rendered_chat_names)
+        query = query.on_conflict_do_update(
+            index_elements=[self.rendered_chat_names.columns.chat_handle],
+            set_={"chat_name": query.excluded.chat_name}
+        )
+        self.conn.execute(query, [
+            {"chat_handle": chat_handle, "chat_name": chat_name} for chat_handle, chat_name in chat_names.items()
+        ])
+
+    def get_cached_entities(self, entity_type: str, entity_keys: List[str]) -> Dict[str, sqlalchemy.engine.Row]:
+        cached = {}
+        for chunk_start in range(0, len(entity_keys), self.QUERY_CHUNK_SIZE):
+            query = sqlalchemy.select(
+                self.entities.columns
+            ).where(
+                sqlalchemy.and_(
+                    self.entities.columns.entity_type == entity_type,
+                    self.entities.columns.entity_key.in_(
+                        entity_keys[chunk_start:chunk_start + self.QUERY_CHUNK_SIZE]
+                    )
+                )
+            )
+            result = self.conn.execute(query)
+            cached.update({row.entity_key: row for row in result.fetchall()})
+        return cached
+
+    def save_cached_entities(self, entity_type: str, names: Dict[str, Tuple[str, str]]) -> None:
+        if not names:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        query = self._dialect_insert(self.entities)
+        query = query.on_conflict_do_update(
+            index_elements=[self.entities.columns.entity_type, self.entities.columns.entity_key],
+            set_={
+                "name": query.excluded.name,
+                "unique_name": query.excluded.unique_name,
+                "updated_at": query.excluded.updated_at
+            }
+        )
+        self.conn.execute(query, [
+            {
+                "entity_type": entity_type,
+                "entity_key": entity_key,
+                "name": name,
+                "unique_name": unique_name,
+                "updated_at": now
+            } for entity_key, (name, unique_name) in names.items()
+        ])
+
+    def get_user_photos(self, user_ids: List[int]) -> Dict[int, sqlalchemy.engine.Row]:
+        photos = {}
+        for chunk_start in range(0, len(user_ids), self.QUERY_CHUNK_SIZE):
+            query = sqlalchemy.select(
+                self.user_photos.columns
+            ).where(
+                self.user_photos.columns.user_id.in_(user_ids[chunk_start:chunk_start + self.QUERY_CHUNK_SIZE])
+            )
+            result = self.conn.execute(query)
+            photos.update({row.user_id: row for row in result.fetchall()})
+        return photos
+
+    def save_user_photo_ids(self, photo_ids: Dict[int, Optional[int]]) -> None:
+        if not photo_ids:
+            return
+        query = self._dialect_insert(self.user_photos)
+        query = query.on_conflict_do_update(
+            index_elements=[self.user_photos.columns.user_id],
+            set_={"photo_id": query.excluded.photo_id}
+        )
+        self.conn.execute(query, [
+            {"user_id": user_id, "photo_id": photo_id} for user_id, photo_id in photo_ids.items()
+        ])
+
+    def save_downloaded_photo_ids(self, downloaded_photo_ids: Dict[int, Optional[int]]) -> None:
+        if not downloaded_photo_ids:
+            return
+        query = sqlalchemy.update(
+            self.user_photos
+        ).where(
+            self.user_photos.columns.user_id == sqlalchemy.bindparam("b_user_id")
+        ).values(
+            downloaded_photo_id=sqlalchemy.bindparam("b_downloaded_photo_id")
+        )
+        self.conn.execute(query, [
+            {"b_user_id": user_id, "b_downloaded_photo_id": photo_id}
+            for user_id, photo_id in downloaded_photo_ids.items()
+        ])
 
     def list_log_dates(self, chat_handle: str) -> List[datetime.date]:
-        cols = [sqlalchemy.cast(self.log_entries.columns.datetime, sqlalchemy.Date)]
-        if self.engine.url.drivername == "sqlite":
-            cols = [sqlalchemy.func.DATE(self.log_entries.columns.datetime).label("datetime")]
         query = sqlalchemy.select(
-            cols
+            [self.log_entries.columns.log_date]
         ).distinct(
         ).where(
             self.log_entries.columns.chat_handle == chat_handle
         ).order_by(
-            sqlalchemy.asc(self.log_entries.columns.datetime)
+            sqlalchemy.asc(self.log_entries.columns.log_date)
         )
         result = self.conn.execute(query)
-        rows = result.fetchall()
-        if self.engine.url.drivername == "sqlite":
-            return [
-                datetime.date.fromisoformat(row.datetime) for row in rows
-            ]
         return [
-            row.datetime for row in rows
+            row.log_date for row in result.fetchall()
         ]
 
     def list_log_entries(self, chat_handle: str, log_date: Optional[datetime.date]):
@@ -74,12 +796,7 @@ class Database:
             self.log_entries.columns.chat_handle == chat_handle
         ]
         if log_date:
-            start_datetime = datetime.datetime.combine(log_date, datetime.time(0, 0, 0))
-            end_datetime = start_datetime + datetime.timedelta(days=1)
-            conditions.extend([
-                self.log_entries.columns.datetime >= start_datetime,
-                self.log_entries.columns.datetime < end_datetime
-            ])
+            conditions.append(self.log_entries.columns.log_date == log_date)
         query = sqlalchemy.select(
             self.log_entries.columns
         ).where(
@@ -94,17 +811,172 @@ class Database:
             for row in result.fetchall()
         ]
 
-    def list_user_ids(self, chat_handle: str) -> Set[int]:
+    def iter_log_days(
+            self,
+            chat_handle: str,
+            dirty_only: bool = False,
+            start_date: Optional[datetime.date] = None,
+            end_date: Optional[datetime.date] = None,
+            chunk_size: Optional[int] = None,
+            as_rows: bool = False
+    ) -> Iterator[Tuple[datetime.date, Iterator[Union["LogEntry", sqlalchemy.engine.Row]]]]:
+        # One query per chat (or per date range of it), read through a server-side cursor in chunks. Each day's
+        # entries are yielded lazily, so they must be consumed before moving on to the next day. With as_rows, the
+        # raw rows are yielded rather than LogEntry objects.
+        log_date_col = self.log_entries.columns.log_date
+        conditions = [
+            self.log_entries.columns.chat_handle == chat_handle
+        ]
+        if start_date:
+            conditions.append(log_date_col >= start_date)
+        if end_date:
+            conditions.append(log_date_col <= end_date)
         query = sqlalchemy.select(
-            self.log_entries.columns.user_id
-        ).distinct(
-            self.log_entries.columns.user_id
+            self.log_entries.columns
         ).where(
+            sqlalchemy.and_(*conditions)
+        )
+        if dirty_only:
+            query = query.select_from(
+                self.log_entries.join(
+                    self.dirty_log_dates,
+                    sqlalchemy.and_(
+                        self.dirty_log_dates.columns.chat_handle == self.log_entries.columns.chat_handle,
+                        self.dirty_log_dates.columns.log_date == log_date_col
+                    )
+                )
+            )
+        query = query.order_by(
+            sqlalchemy.asc(log_date_col),
+            sqlalchemy.asc(self.log_entries.columns.message_id),
+            sqlalchemy.asc(self.log_entries.columns.sub_message_id)
+        )
+        result = self.conn.execution_options(stream_results=True).execute(query)
+        rows = (row for partition in result.partitions(chunk_size or self.EXPORT_CHUNK_SIZE) for row in partition)
+        for log_date, day_rows in itertools.groupby(rows, key=lambda row: row.log_date):
+            if as_rows:
+                yield log_date, day_rows
+            else:
+                yield log_date, (LogEntry.from_row(row) for row in day_rows)
+
+    def iter_log_entries_after(
+            self,
+            chat_handle: str,
+            message_id: Optional[int] = None,
+            chunk_size: Optional[int] = None
+    ) -> Iterator[List[sqlalchemy.engine.Row]]:
+        # Yields chunks of raw rows in message order, read through a server-side cursor, for exports which keep their
+        # own high-water mark
+        conditions = [
             self.log_entries.columns.chat_handle == chat_handle
+        ]
+        if message_id is not None:
+            conditions.append(self.log_entries.columns.message_id > message_id)
+        query = sqlalchemy.select(
+            self.log_entries.columns
+        ).where(
+            sqlalchemy.and_(*conditions)
+        ).order_by(
+            sqlalchemy.asc(self.log_entries.columns.message_id),
+            sqlalchemy.asc(self.log_entries.columns.sub_message_id)
+        )
+        result = self.conn.execution_options(stream_results=True).execute(query)
+        yield from result.partitions(chunk_size or self.EXPORT_CHUNK_SIZE)
+
+    def count_log_entries(self, chat_handle: Optional[str] = None) -> int:
+        query = sqlalchemy.select(
+            [sqlalchemy.func.count()]
+        ).select_from(
+            self.log_entries
+        )
+        if chat_handle is not None:
+            query = query.where(self.log_entries.columns.chat_handle == chat_handle)
+        return self.conn.execute(query).scalar()
+
+    def list_user_ids(self, chat_handles: List[str]) -> Set[int]:
+        query = sqlalchemy.select(
+            self.participants.columns.user_id
+        ).distinct(
+        ).where(
+            self.participants.columns.chat_handle.in_(chat_handles)
         )
         result = self.conn.execute(query)
         return set([row.user_id for row in result.fetchall()])
 
+    def _list_overlapping_ranges(self, chat_handle: str, start_id: int, end_id: int) -> List[sqlalchemy.engine.Row]:
+        query = sqlalchemy.select(
+            self.fetched_ranges.columns
+        ).where(
+            sqlalchemy.and_(
+                self.fetched_ranges.columns.chat_handle == chat_handle,
+                self.fetched_ranges.columns.start_message_id <= end_id,
+                self.fetched_ranges.columns.end_message_id >= start_id
+            )
+        )
+        return self.conn.execute(query).fetchall()
+
+    def _delete_fetched_ranges(self, chat_handle: str, start_ids: List[int]) -> None:
+        if not start_ids:
+            return
+        query = sqlalchemy.delete(
+            self.fetched_ranges
+        ).where(
+            sqlalchemy.and_(
+                self.fetched_ranges.columns.chat_handle == chat_handle,
+                self.fetched_ranges.columns.start_message_id.in_(start_ids)
+            )
+        )
+        self.conn.execute(query)
+
+    def add_fetched_ranges(self, chat_handle: str, ranges: List[Tuple[int, int]]) -> None:
+        # Each range is merged with any it overlaps or touches, so the table holds as few ranges as possible
+        for start_id, end_id in ranges:
+            existing = self._list_overlapping_ranges(chat_handle, start_id - 1, end_id + 1)
+            self._delete_fetched_ranges(chat_handle, [row.start_message_id for row in existing])
+            self.conn.execute(sqlalchemy.insert(self.fetched_ranges).values(
+                chat_handle=chat_handle,
+                start_message_id=min([start_id] + [row.start_message_id for row in existing]),
+                end_message_id=max([end_id] + [row.end_message_id for row in existing])
+            ))
+
+    def remove_fetched_range(self, chat_handle: str, start_id: int, end_id: int) -> None:
+        # Marks a range as not fetched, so the next scrape fetches it again
+        with self.conn.begin():
+            existing = self._list_overlapping_ranges(chat_handle, start_id, end_id)
+            self._delete_fetched_ranges(chat_handle, [row.start_message_id for row in existing])
+            remaining = [
+                (row.start_message_id, start_id - 1) for row in existing if row.start_message_id < start_id
+            ] + [
+                (end_id + 1, row.end_message_id) for row in existing if row.end_message_id > end_id
+            ]
+            if remaining:
+                self.conn.execute(sqlalchemy.insert(self.fetched_ranges), [
+                    {"chat_handle": chat_handle, "start_message_id": start, "end_message_id": end}
+                    for start, end in remaining
+                ])
+
+    def list_fetched_ranges(self, chat_handle: str) -> List[Tuple[int, int]]:
+        query = sqlalchemy.select(
+            [self.fetched_ranges.columns.start_message_id, self.fetched_ranges.columns.end_message_id]
+        ).where(
+            self.fetched_ranges.columns.chat_handle == chat_handle
+        ).order_by(
+            sqlalchemy.asc(self.fetched_ranges.columns.start_message_id)
+        )
+        return [(row.start_message_id, row.end_message_id) for row in self.conn.execute(query).fetchall()]
+
+    def list_missing_ranges(self, chat_handle: str, last_message_id: Optional[int]) -> List[Tuple[int, int]]:
+        # Gaps between the start of the chat and its high-water mark. Anything newer is fetched by the normal scrape.
+        missing = []
+        next_id = 1
+        for start_id, end_id in self.list_fetched_ranges(chat_handle):
+            if start_id > next_id:
+                missing.append((next_id, start_id - 1))
+            next_id = max(next_id, end_id + 1)
+        if last_message_id is not None and next_id <= last_message_id:
+            missing.append((next_id, last_message_id))
+        return missing
+
     def update_chat_log(self, chat_handle: str, last_message_id: Optional[int]):
         query = sqlalchemy.update(
             self.chat_logs
@@ -115,6 +987,13 @@ class Database:
         )
         self.conn.execute(query)
 
+    def list_chat_handles(self) -> List[str]:
+        query = sqlalchemy.select(
+            [self.chat_logs.columns.chat_handle]
+        )
+        result = self.conn.execute(query)
+        return [row.chat_handle for row in result.fetchall()]
+
     def create_chat_log(self, chat_handle: str) -> None:
         query = sqlalchemy.insert(
             self.chat_logs
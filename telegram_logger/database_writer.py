@@ -0,0 +1,80 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, TYPE_CHECKING
+
+from telegram_logger.instrumentation import instrumentation
+
+if TYPE_CHECKING:
+    from telegram_logger.chat_log import ChatLog
+    from telegram_logger.database import Database
+    from telegram_logger.log_entry import LogEntry
+
+
+DEFAULT_QUEUE_SIZE = 8
+
+
+class DatabaseWriter:
+    # Writes batches of log entries on a single background thread, so the event loop carries on fetching messages
+    # while inserts run. The queue is bounded, so when writing falls behind, fetching waits for it.
+    def __init__(self, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="database_writer")
+        self._databases = set()
+        self._task = None  # type: Optional[asyncio.Task]
+        self._error = None  # type: Optional[BaseException]
+
+    async def __aenter__(self) -> "DatabaseWriter":
+        self._task = asyncio.ensure_future(self._drain())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # Batches already queued are still written, as each one carries a valid checkpoint
+        await self.queue.put(None)
+        await self._task
+        loop = asyncio.get_running_loop()
+        for database in self._databases:
+            await loop.run_in_executor(self.executor, database.close_thread_connection)
+        self.executor.shutdown()
+        if self._error is not None and exc_type is None:
+            raise self._error
+
+    async def submit(
+            self,
+            chat_log: "ChatLog",
+            log_entries: List["LogEntry"],
+            last_message_id: Optional[int],
+            fetched_ranges: List[Tuple[int, int]]
+    ):
+        if self._error is not None:
+            raise self._error
+        if self.queue.full():
+            # Counts how often fetching is held back by the database
+            instrumentation.increment("write_queue_full")
+        await self.queue.put((chat_log, log_entries, last_message_id, fetched_ranges))
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                # Keeps emptying the queue after a failure, so no fetch is left waiting on it
+                continue
+            chat_log, log_entries, last_message_id, fetched_ranges = item
+            database = chat_log.db  # type: Database
+            self._databases.add(database)
+            try:
+                await loop.run_in_executor(
+                    self.executor,
+                    database.insert_log_entries,
+                    chat_log.handle,
+                    log_entries,
+                    last_message_id,
+                    fetched_ranges
+                )
+            except Exception as e:
+                self._error = e
+                continue
+            if last_message_id is not None:
+                chat_log.last_message_id = last_message_id
@@ -0,0 +1,95 @@
+import datetime
+from typing import Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+from telegram_logger.instrumentation import instrumentation
+from telegram_logger.telegram_utils import get_chat_name, get_user_name, get_user_name_unique_deleted
+
+if TYPE_CHECKING:
+    from telegram_logger.database import Database
+
+
+class EntityCache:
+    TYPE_CHAT = "chat"
+    TYPE_USER = "user"
+    LOOKUP_BATCH_SIZE = 200
+
+    def __init__(self, db: "Database", ttl: datetime.timedelta = datetime.timedelta(days=1)):
+        self.db = db
+        self.ttl = ttl
+        self.names = {}  # type: Dict[Tuple[str, str], Tuple[str, str]]
+        # When each name in memory was looked up, so long running processes still look names up again once stale
+        self.updated_at = {}  # type: Dict[Tuple[str, str], datetime.datetime]
+
+    async def load_users(self, client, user_ids: Iterable[int]) -> None:
+        await self._load(client, self.TYPE_USER, [str(user_id) for user_id in user_ids])
+
+    async def load_chats(self, client, chat_handles: Iterable[str]) -> None:
+        await self._load(client, self.TYPE_CHAT, [str(chat_handle) for chat_handle in chat_handles])
+
+    # Each name is None if it has never been looked up, which can only happen when running offline
+    def user_name(self, user_id: int) -> Optional[str]:
+        return self.names.get((self.TYPE_USER, str(user_id)), (None, None))[0]
+
+    def unique_user_name(self, user_id: int) -> Optional[str]:
+        return self.names.get((self.TYPE_USER, str(user_id)), (None, None))[1]
+
+    def chat_name(self, chat_handle: str) -> Optional[str]:
+        return self.names.get((self.TYPE_CHAT, str(chat_handle)), (None, None))[0]
+
+    async def _load(self, client, entity_type: str, entity_keys: List[str]) -> None:
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        expiry = now - self.ttl
+        entity_keys = [
+            key for key in entity_keys
+            if (entity_type, key) not in self.updated_at or self.updated_at[(entity_type, key)] < expiry
+        ]
+        cached = self.db.get_cached_entities(entity_type, entity_keys)
+        for key, row in cached.items():
+            self.names[(entity_type, key)] = (row.name, row.unique_name)
+            self.updated_at[(entity_type, key)] = row.updated_at
+        stale_keys = [key for key in entity_keys if key not in cached or cached[key].updated_at < expiry]
+        if entity_type == self.TYPE_USER:
+            # Users cached before photo IDs were tracked need looking up again
+            photos = self.db.get_user_photos([int(key) for key in entity_keys])
+            stale_keys = [
+                key for key in entity_keys
+                if key not in cached or cached[key].updated_at < expiry or int(key) not in photos
+            ]
+        if client is None:
+            uncached_count = len([key for key in entity_keys if key not in cached])
+            if uncached_count:
+                print(f"- No cached name for {uncached_count} {entity_type}s, so their existing output is kept. Run "
+                      f"scrape or all to look them up.")
+            return
+        for chunk_start in range(0, len(stale_keys), self.LOOKUP_BATCH_SIZE):
+            chunk = stale_keys[chunk_start:chunk_start + self.LOOKUP_BATCH_SIZE]
+            # Telethon resolves a list of entities in as few requests as it can
+            with instrumentation.phase("entity_lookup"):
+                entities = await client.get_entity([self._to_entity_like(entity_type, key) for key in chunk])
+            instrumentation.increment("entities_resolved", len(chunk))
+            fetched = {
+                key: self._names_for_entity(entity_type, entity)
+                for key, entity in zip(chunk, entities)
+            }
+            self.db.save_cached_entities(entity_type, fetched)
+            if entity_type == self.TYPE_USER:
+                self.db.save_user_photo_ids({
+                    int(key): getattr(getattr(entity, "photo", None), "photo_id", None)
+                    for key, entity in zip(chunk, entities)
+                })
+            for key, names in fetched.items():
+                self.names[(entity_type, key)] = names
+                self.updated_at[(entity_type, key)] = now
+
+    @classmethod
+    def _to_entity_like(cls, entity_type: str, entity_key: str):
+        if entity_type == cls.TYPE_USER or entity_key.lstrip("-").isdigit():
+            return int(entity_key)
+        return entity_key
+
+    @classmethod
+    def _names_for_entity(cls, entity_type: str, entity) -> Tuple[str, str]:
+        if entity_type == cls.TYPE_CHAT:
+            chat_name = get_chat_name(entity)
+            return chat_name, chat_name
+        return get_user_name(entity), get_user_name_unique_deleted(entity)
@@ -0,0 +1,143 @@
+import collections
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import sqlalchemy
+
+
+class TimingStats:
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_json(self) -> Dict:
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total_seconds, 6),
+            "mean_seconds": round(self.total_seconds / self.count, 6) if self.count else None,
+            "max_seconds": round(self.max_seconds, 6)
+        }
+
+
+class Instrumentation:
+
+    def __init__(self):
+        self.phases = collections.defaultdict(TimingStats)
+        self.counters = collections.Counter()
+        self.timings = collections.defaultdict(lambda: collections.defaultdict(TimingStats))
+        self.profile_phase = None  # type: Optional[str]
+        self.profile_output = None  # type: Optional[str]
+        # Counters and timings are also updated from the database writer thread
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        profiler = None
+        if name == self.profile_phase:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name].add(time.perf_counter() - start)
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.profile_output or f"profile_{name}.prof")
+
+    def increment(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def record_timing(self, category: str, name: str, seconds: float):
+        with self._lock:
+            self.timings[category][name].add(seconds)
+
+    def instrument_client_class(self, client_class: type) -> type:
+        # Subclasses TelegramClient so every request it sends is timed, including the pages of history fetched inside
+        # iter_messages() and the file parts of downloads. Telethon sends all of them through _call().
+        instrumentation = self
+
+        class InstrumentedTelegramClient(client_class):
+            async def _call(self, sender, request, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await super()._call(sender, request, *args, **kwargs)
+                finally:
+                    instrumentation.record_timing("rpc", type(request).__name__, time.perf_counter() - start)
+
+        return InstrumentedTelegramClient
+
+    def attach_engine(self, engine: sqlalchemy.engine.Engine):
+        @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+        @sqlalchemy.event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            seconds = time.perf_counter() - conn.info["query_start"].pop()
+            statement_type = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+            self.record_timing("sql", statement_type, seconds)
+
+    def report(self) -> Dict:
+        scrape_seconds = self.phases["scrape"].total_seconds if "scrape" in self.phases else 0
+        return {
+            "phases": {name: stats.to_json() for name, stats in self.phases.items()},
+            "counters": dict(self.counters),
+            "messages_per_second": (
+                round(self.counters["messages_scraped"] / scrape_seconds, 2) if scrape_seconds else None
+            ),
+            "rpc": {name: stats.to_json() for name, stats in self.timings["rpc"].items()},
+            "sql": {name: stats.to_json() for name, stats in self.timings["sql"].items()}
+        }
+
+    def write_json(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_prometheus(self, path: str):
+        lines = [
+            "# HELP telepisg_phase_seconds Wall time spent in each phase of the last run",
+            "# TYPE telepisg_phase_seconds gauge",
+            *[
+                f'telepisg_phase_seconds{{phase="{name}"}} {stats.total_seconds}'
+                for name, stats in self.phases.items()
+            ],
+            "# HELP telepisg_events Count of items processed in the last run",
+            "# TYPE telepisg_events gauge",
+            *[f'telepisg_events{{name="{name}"}} {count}' for name, count in self.counters.items()]
+        ]
+        for category, description in [("rpc", "Telegram requests"), ("sql", "SQL statements")]:
+            lines.extend([
+                f"# HELP telepisg_{category}_requests Count of {description} made in the last run",
+                f"# TYPE telepisg_{category}_requests gauge",
+                *[
+                    f'telepisg_{category}_requests{{name="{name}"}} {stats.count}'
+                    for name, stats in self.timings[category].items()
+                ],
+                f"# HELP telepisg_{category}_seconds Total time spent on {description} in the last run",
+                f"# TYPE telepisg_{category}_seconds gauge",
+                *[
+                    f'telepisg_{category}_seconds{{name="{name}"}} {stats.total_seconds}'
+                    for name, stats in self.timings[category].items()
+                ]
+            ])
+        # Written to a temporary file and renamed, so the node exporter never reads a partial file
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(f"{path}.tmp", path)
+
+
+instrumentation = Instrumentation()
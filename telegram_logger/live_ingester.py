@@ -0,0 +1,94 @@
+import asyncio
+import datetime
+from typing import Dict, TYPE_CHECKING
+
+from telethon import events
+from telethon.utils import get_peer_id
+
+from telegram_logger.chat_log import DEFAULT_BATCH_SIZE
+from telegram_logger.instrumentation import instrumentation
+from telegram_logger.log_entry import LogEntry
+
+if TYPE_CHECKING:
+    from telegram_logger.chat_log import ChatLog
+    from telegram_logger.data_store import DataStore
+
+
+class LiveIngester:
+
+    def __init__(
+            self,
+            data_store: "DataStore",
+            client,
+            batch_size: int = 50,
+            flush_interval: float = 30,
+            scrape_concurrency: int = 4,
+            scrape_batch_size: int = DEFAULT_BATCH_SIZE,
+            compress_closed_days: bool = False
+    ):
+        self.data_store = data_store
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.scrape_concurrency = scrape_concurrency
+        self.scrape_batch_size = scrape_batch_size
+        self.compress_closed_days = compress_closed_days
+        self.queue = asyncio.Queue()
+        self.chat_logs_by_peer_id = {}  # type: Dict[int, ChatLog]
+        self.rendered_date = None
+
+    async def run(self):
+        # The handler is registered before catching up, so nothing sent during the catch-up scrape is missed. Queued
+        # messages which the catch-up already stored are skipped.
+        for chat_log in self.data_store.chat_logs:
+            entity = await self.client.get_entity(chat_log.handle)
+            self.chat_logs_by_peer_id[get_peer_id(entity)] = chat_log
+        self.client.add_event_handler(
+            self.on_new_message,
+            events.NewMessage(chats=list(self.chat_logs_by_peer_id.keys()))
+        )
+        print("- Catching up on messages sent while stopped")
+        await self.data_store.update_all_logs(self.client, self.scrape_concurrency, self.scrape_batch_size)
+        await self.data_store.write_all_logs(self.client, compress_closed_days=self.compress_closed_days)
+        self.rendered_date = datetime.date.today()
+        print("- Listening for new messages")
+        await asyncio.gather(self.consume(), self.flush_periodically(), self.client.run_until_disconnected())
+
+    async def on_new_message(self, event):
+        await event.message.get_sender()
+        await self.queue.put(event.message)
+
+    async def consume(self):
+        while True:
+            message = await self.queue.get()
+            chat_log = self.chat_logs_by_peer_id.get(message.chat_id)
+            if chat_log is None or (chat_log.last_message_id is not None and message.id <= chat_log.last_message_id):
+                continue
+            chat_name = self.data_store.entity_cache.chat_name(chat_log.handle)
+            chat_log.add_entries(LogEntry.entries_from_message(message, chat_name), message.id, batch_size=None)
+            instrumentation.increment("messages_received")
+            if chat_log.pending_message_count >= self.batch_size:
+                await self.flush_chat(chat_log)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            for chat_log in self.data_store.chat_logs:
+                await self.flush_chat(chat_log)
+            if datetime.date.today() != self.rendered_date:
+                # Closes off yesterday's logs, even if nothing has been said today yet
+                await self.data_store.write_all_logs(self.client, compress_closed_days=self.compress_closed_days)
+                self.rendered_date = datetime.date.today()
+
+    async def flush_chat(self, chat_log: "ChatLog"):
+        log_entries = chat_log.flush_entries()
+        if not log_entries:
+            return
+        self.data_store.user_ids.update(entry.user_id for entry in log_entries)
+        await self.data_store.entity_cache.load_users(self.client, self.data_store.user_ids)
+        user_id_lookup = {
+            user_id: self.data_store.entity_cache.unique_user_name(user_id)
+            for user_id in self.data_store.user_ids
+        }
+        chat_name = self.data_store.entity_cache.chat_name(chat_log.handle)
+        chat_log.append_log_lines(log_entries, user_id_lookup, chat_name, self.compress_closed_days)
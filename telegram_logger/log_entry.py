@@ -1,11 +1,17 @@
 import datetime
 from typing import Dict
 
-from telethon.tl.types import MessageActionChatDeleteUser, MessageActionChatAddUser, MessageMediaDocument, \
-    MessageMediaPhoto
+
+def to_naive_utc(value: datetime.datetime) -> datetime.datetime:
+    # Telethon gives timezone aware datetimes. They are stored as naive UTC, so the database never converts them to
+    # its session time zone, and the log date and hour worked out here match those the database works out.
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
 
 
 class LogEntry:
+    __slots__ = ("log_datetime", "log_type", "user_id", "text", "message_id", "sub_message_id")
     TYPE_TEXT = "TEXT"
     TYPE_JOIN = "JOIN"
     TYPE_QUIT = "QUIT"
@@ -20,7 +26,7 @@ class LogEntry:
             message_id: int,
             sub_message_id: int
     ):
-        self.log_datetime = log_datetime
+        self.log_datetime = to_naive_utc(log_datetime)
         self.log_type = log_type
         self.user_id = user_id
         self.text = text
@@ -35,7 +41,8 @@ class LogEntry:
             "user_id": self.user_id,
             "text": self.text,
             "message_id": self.message_id,
-            "sub_message_id": self.sub_message_id
+            "sub_message_id": self.sub_message_id,
+            "log_date": self.log_datetime.date()
         }
 
     @staticmethod
@@ -51,6 +58,9 @@ class LogEntry:
 
     @classmethod
     def entries_from_message(cls, message, log_name):
+        # Imported here, so rendering from the database does not need telethon
+        from telethon.tl.types import MessageActionChatDeleteUser, MessageActionChatAddUser, MessageMediaDocument, \
+            MessageMediaPhoto
         if isinstance(message.action, MessageActionChatDeleteUser):
             return [LogEntry(
                 message.date,
@@ -70,14 +80,15 @@ class LogEntry:
                 0
             )]
         elif message.text:
+            # Stored as one entry, however many lines it has. The lines are split when rendering.
             return [LogEntry(
                 message.date,
                 cls.TYPE_TEXT,
                 message.sender.id,
-                text,
+                message.text,
                 message.id,
-                sub_id
-            ) for sub_id, text in enumerate(message.text.split("\n")[::-1])]
+                0
+            )]
         elif message.media and isinstance(message.media, MessageMediaDocument):
             return [LogEntry(
                 message.date,
@@ -98,13 +109,26 @@ class LogEntry:
             )]
 
     def to_log_line(self, user_id_lookup):
-        time = self.log_datetime.time().isoformat()
-        user_name = user_id_lookup[self.user_id]
-        if self.log_type == self.TYPE_QUIT:
-            return f"{time} -!- {user_name} {self.text}"
-        elif self.log_type == self.TYPE_JOIN:
-            return f"{time} -!- {user_name} {self.text}"
-        elif self.log_type == self.TYPE_TEXT:
-            return f"{time} < {user_name}> {self.text}"
-        elif self.log_type == self.TYPE_ACTION:
-            return f"{time} * {user_name} {self.text}"
+        return format_log_line(self.log_datetime, self.log_type, user_id_lookup[self.user_id], self.text)
+
+    @staticmethod
+    def log_line_from_row(row, user_id_lookup) -> str:
+        # Fast path for rendering, which formats straight from a database row without building a LogEntry
+        return format_log_line(row.datetime, row.entry_type, user_id_lookup[row.user_id], row.text)
+
+
+LINE_FORMATTERS = {
+    LogEntry.TYPE_QUIT: lambda time, user_name, text: f"{time} -!- {user_name} {text}",
+    LogEntry.TYPE_JOIN: lambda time, user_name, text: f"{time} -!- {user_name} {text}",
+    LogEntry.TYPE_TEXT: lambda time, user_name, text: f"{time} < {user_name}> {text}",
+    LogEntry.TYPE_ACTION: lambda time, user_name, text: f"{time} * {user_name} {text}"
+}
+
+
+def format_log_line(log_datetime: datetime.datetime, log_type: str, user_name: str, text: str) -> str:
+    formatter = LINE_FORMATTERS[log_type]
+    time = log_datetime.time().isoformat()
+    if "\n" not in text:
+        return formatter(time, user_name, text)
+    # Each line of a multi-line message gets its own log line, last line first, as they were always rendered
+    return "\n".join(formatter(time, user_name, line) for line in reversed(text.split("\n")))
@@ -0,0 +1,52 @@
+import asyncio
+from typing import List, TYPE_CHECKING
+
+from tqdm import tqdm
+
+from telegram_logger.chat_log import DEFAULT_BATCH_SIZE
+from telegram_logger.database_writer import DatabaseWriter, DEFAULT_QUEUE_SIZE
+
+if TYPE_CHECKING:
+    from telegram_logger.chat_log import ChatLog
+
+
+class ScrapeScheduler:
+
+    def __init__(
+            self,
+            client,
+            concurrency: int = 4,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            queue_size: int = DEFAULT_QUEUE_SIZE,
+            sleep=asyncio.sleep
+    ):
+        self.client = client
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.sleep = sleep
+
+    async def scrape_all(self, chat_logs: List["ChatLog"]):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with tqdm(total=0, unit="msg") as bar:
+            async with DatabaseWriter(self.queue_size) as writer:
+                await asyncio.gather(*(self._scrape_chat(chat_log, semaphore, bar, writer) for chat_log in chat_logs))
+
+    async def _scrape_chat(
+            self,
+            chat_log: "ChatLog",
+            semaphore: asyncio.Semaphore,
+            bar: tqdm,
+            writer: DatabaseWriter
+    ):
+        from telethon.errors import FloodWaitError
+        while True:
+            async with semaphore:
+                try:
+                    await chat_log.scrape_messages(self.client, bar, writer, self.batch_size)
+                    return
+                except FloodWaitError as e:
+                    wait_seconds = e.seconds
+            # The slot is released while backing off, so other chats keep scraping
+            bar.write(f"- Flood wait on {chat_log.handle}, backing off for {wait_seconds} seconds")
+            await self.sleep(wait_seconds)
@@ -0,0 +1,180 @@
+import json
+import os
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+import numpy
+
+from telegram_logger.log_entry import LogEntry
+
+if TYPE_CHECKING:
+    from telegram_logger.database import Database
+
+
+ENTRY_TYPES = [LogEntry.TYPE_TEXT, LogEntry.TYPE_JOIN, LogEntry.TYPE_QUIT, LogEntry.TYPE_ACTION]
+ENTRY_TYPE_CODES = {entry_type: code for code, entry_type in enumerate(ENTRY_TYPES)}
+COLUMN_TYPES = {
+    "datetime": "datetime64[s]",
+    "user_id": "int64",
+    "entry_type": "int8",
+    "message_id": "int64"
+}
+META_FILE = "meta.json"
+TEXT_FILE = "text.bin"
+TEXT_OFFSETS_FILE = "text_offsets.npy"
+# Bumped when the layout of the exported entries changes, so older snapshots are exported again from scratch
+SNAPSHOT_FORMAT = 2
+SECONDS_PER_HOUR = 3600
+SECONDS_PER_DAY = 86400
+
+
+def get_snapshot_dir(output_dir: str, chat_handle: str) -> str:
+    return os.path.join(output_dir, str(chat_handle))
+
+
+def _empty_meta() -> Dict:
+    return {"format": SNAPSHOT_FORMAT, "rows": 0, "text_bytes": 0, "high_water_message_id": None, "fetched_ranges": []}
+
+
+def _load_meta(snapshot_dir: str) -> Dict:
+    try:
+        with open(os.path.join(snapshot_dir, META_FILE), "r") as f:
+            meta = json.load(f)
+        if meta.get("format") == SNAPSHOT_FORMAT:
+            return meta
+    except FileNotFoundError:
+        pass
+    return _empty_meta()
+
+
+def _ranges_below(fetched_ranges: List[Tuple[int, int]], high_water_message_id: Optional[int]) -> List[List[int]]:
+    if high_water_message_id is None:
+        return []
+    return [
+        [start_id, min(end_id, high_water_message_id)]
+        for start_id, end_id in fetched_ranges
+        if start_id <= high_water_message_id
+    ]
+
+
+def _save_array(path: str, array: numpy.ndarray) -> None:
+    with open(f"{path}.tmp", "wb") as f:
+        numpy.save(f, array)
+    os.replace(f"{path}.tmp", path)
+
+
+def export_snapshot(db: "Database", chat_handle: str, output_dir: str = "snapshots") -> int:
+    # Appends the entries stored since the last export to the chat's snapshot, and returns how many were added. The
+    # metadata is written last, so an interrupted export is simply redone from the previous high-water mark. If gaps
+    # below the high-water mark have been filled in since, the snapshot is exported again from scratch.
+    snapshot_dir = get_snapshot_dir(output_dir, chat_handle)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    meta = _load_meta(snapshot_dir)
+    fetched_ranges = db.list_fetched_ranges(chat_handle)
+    if meta.get("fetched_ranges") != _ranges_below(fetched_ranges, meta["high_water_message_id"]):
+        meta = _empty_meta()
+    new_columns = {name: [] for name in COLUMN_TYPES}
+    text_lengths = []
+    high_water_message_id = meta["high_water_message_id"]
+    with open(os.path.join(snapshot_dir, TEXT_FILE), "ab") as text_file:
+        # Drops any text left over from an interrupted export
+        text_file.truncate(meta["text_bytes"])
+        for rows in db.iter_log_entries_after(chat_handle, high_water_message_id):
+            new_columns["datetime"].append(numpy.array([row.datetime for row in rows], dtype="datetime64[s]"))
+            new_columns["user_id"].append(numpy.array([row.user_id or 0 for row in rows], dtype="int64"))
+            new_columns["entry_type"].append(
+                numpy.array([ENTRY_TYPE_CODES[row.entry_type] for row in rows], dtype="int8")
+            )
+            new_columns["message_id"].append(numpy.array([row.message_id for row in rows], dtype="int64"))
+            texts = [(row.text or "").encode("utf-8") for row in rows]
+            text_file.write(b"".join(texts))
+            text_lengths.append(numpy.array([len(text) for text in texts], dtype="int64"))
+            high_water_message_id = rows[-1].message_id
+    if not text_lengths:
+        return 0
+    for name, chunks in new_columns.items():
+        path = os.path.join(snapshot_dir, f"{name}.npy")
+        existing = [numpy.load(path)] if meta["rows"] else []
+        _save_array(path, numpy.concatenate(existing + chunks))
+    offsets_path = os.path.join(snapshot_dir, TEXT_OFFSETS_FILE)
+    existing_offsets = numpy.load(offsets_path) if meta["rows"] else numpy.zeros(1, dtype="int64")
+    new_offsets = meta["text_bytes"] + numpy.cumsum(numpy.concatenate(text_lengths))
+    _save_array(offsets_path, numpy.concatenate([existing_offsets, new_offsets]))
+    added_rows = len(new_offsets)
+    meta = {
+        "format": SNAPSHOT_FORMAT,
+        "rows": meta["rows"] + added_rows,
+        "text_bytes": int(new_offsets[-1]),
+        "high_water_message_id": high_water_message_id,
+        "fetched_ranges": _ranges_below(fetched_ranges, high_water_message_id)
+    }
+    with open(os.path.join(snapshot_dir, f"{META_FILE}.tmp"), "w") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(snapshot_dir, f"{META_FILE}.tmp"), os.path.join(snapshot_dir, META_FILE))
+    return added_rows
+
+
+class Snapshot:
+
+    def __init__(self, columns: Dict[str, numpy.ndarray], text_offsets: numpy.ndarray, text: numpy.ndarray):
+        self.datetime = columns["datetime"]
+        self.user_id = columns["user_id"]
+        self.entry_type = columns["entry_type"]
+        self.message_id = columns["message_id"]
+        self.text_offsets = text_offsets
+        self.text = text
+
+    @classmethod
+    def load(cls, output_dir: str, chat_handle: str) -> "Snapshot":
+        # The columns and text are memory-mapped, so only the parts a query touches are read from disk
+        snapshot_dir = get_snapshot_dir(output_dir, chat_handle)
+        if not _load_meta(snapshot_dir)["rows"]:
+            return cls(
+                {name: numpy.zeros(0, dtype=dtype) for name, dtype in COLUMN_TYPES.items()},
+                numpy.zeros(1, dtype="int64"),
+                numpy.zeros(0, dtype="uint8")
+            )
+        columns = {
+            name: numpy.load(os.path.join(snapshot_dir, f"{name}.npy"), mmap_mode="r")
+            for name in COLUMN_TYPES
+        }
+        text_offsets = numpy.load(os.path.join(snapshot_dir, TEXT_OFFSETS_FILE), mmap_mode="r")
+        text = numpy.memmap(os.path.join(snapshot_dir, TEXT_FILE), dtype="uint8", mode="r")
+        return cls(columns, text_offsets, text)
+
+    def __len__(self) -> int:
+        return len(self.message_id)
+
+    def get_text(self, index: int) -> str:
+        return bytes(self.text[self.text_offsets[index]:self.text_offsets[index + 1]]).decode("utf-8")
+
+    def _mask(
+            self,
+            user_id: Optional[int] = None,
+            entry_types: Optional[List[str]] = None
+    ) -> numpy.ndarray:
+        # Each entry is one message, however many lines of text it has
+        mask = numpy.ones(len(self), dtype=bool)
+        if user_id is not None:
+            mask &= self.user_id == user_id
+        if entry_types is not None:
+            mask &= numpy.isin(self.entry_type, [ENTRY_TYPE_CODES[entry_type] for entry_type in entry_types])
+        return mask
+
+    def counts_per_day(self, **filters) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        days = self.datetime.view("int64")[self._mask(**filters)] // SECONDS_PER_DAY
+        if not len(days):
+            return numpy.zeros(0, dtype="datetime64[D]"), numpy.zeros(0, dtype="int64")
+        first_day = days.min()
+        counts = numpy.bincount(days - first_day)
+        active_days = numpy.flatnonzero(counts)
+        return (active_days + first_day).astype("datetime64[D]"), counts[active_days]
+
+    def counts_per_hour(self, **filters) -> numpy.ndarray:
+        hours = (self.datetime.view("int64")[self._mask(**filters)] // SECONDS_PER_HOUR) % 24
+        return numpy.bincount(hours, minlength=24)
+
+    def counts_per_user(self, **filters) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        # Sorted with the most active users first
+        user_ids, counts = numpy.unique(self.user_id[self._mask(**filters)], return_counts=True)
+        order = numpy.argsort(-counts, kind="stable")
+        return user_ids[order], counts[order]
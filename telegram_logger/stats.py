@@ -0,0 +1,60 @@
+import csv
+import io
+import json
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+from telegram_logger.database import STAT_COLUMNS
+from telegram_logger.entity_cache import EntityCache
+
+if TYPE_CHECKING:
+    from telegram_logger.database import Database
+
+SERIES_DAY = "day"
+SERIES_USER = "user"
+SERIES_HOUR = "hour"
+FORMAT_CSV = "csv"
+FORMAT_JSON = "json"
+
+
+def resolve_chat_handle(db: "Database", chat: str) -> str:
+    # Accepts either a chat handle, or a chat name from the entity cache (with or without the leading #)
+    for chat_handle, row in db.get_cached_entities(EntityCache.TYPE_CHAT, db.list_chat_handles()).items():
+        if row.name in [chat, f"#{chat}"]:
+            return chat_handle
+    return chat
+
+
+def list_stats(db: "Database", chat_handle: str, series: str, user_id: Optional[int] = None) -> List[Dict]:
+    if series == SERIES_DAY:
+        return [
+            {"date": row.log_date.isoformat(), **{stat: getattr(row, stat) for stat in STAT_COLUMNS}}
+            for row in db.get_daily_stats(chat_handle, user_id)
+        ]
+    if series == SERIES_USER:
+        rows = db.get_user_stats(chat_handle)
+        names = db.get_cached_entities(EntityCache.TYPE_USER, [str(row.user_id) for row in rows])
+        return [
+            {
+                "user_id": row.user_id,
+                "user_name": names[str(row.user_id)].unique_name if str(row.user_id) in names else None,
+                **{stat: getattr(row, stat) for stat in STAT_COLUMNS}
+            }
+            for row in rows
+        ]
+    if series == SERIES_HOUR:
+        return [
+            {"hour": row.hour, **{stat: getattr(row, stat) for stat in STAT_COLUMNS}}
+            for row in db.get_hourly_stats(chat_handle)
+        ]
+    raise ValueError(f"Unknown stats series: {series}")
+
+
+def format_stats(rows: List[Dict], output_format: str) -> str:
+    if output_format == FORMAT_JSON:
+        return json.dumps(rows, indent=2)
+    output = io.StringIO()
+    if rows:
+        writer = csv.DictWriter(output, fieldnames=list(rows[0].keys()), lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+    return output.getvalue()
@@ -1,7 +1,3 @@
-from telethon.tl.functions.messages import GetHistoryRequest
-from telethon.tl.types.messages import Messages
-
-
 def get_chat_name(entity):
     if hasattr(entity, "title"):
         return f"#{entity.title}"
@@ -19,6 +15,8 @@ def get_user_name(user):
 
 
 async def get_message_count(client, entity, latest_id=0):
+    from telethon.tl.functions.messages import GetHistoryRequest
+    from telethon.tl.types.messages import Messages
     get_history = GetHistoryRequest(
         peer=entity,
         offset_id=0,
@@ -0,0 +1,62 @@
+import datetime
+
+import pytest
+
+from telegram_logger.database import Database
+from telegram_logger.log_entry import LogEntry
+
+START = datetime.datetime(2021, 3, 1, 12)
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(f"sqlite:///{tmp_path / 'test.db'}")
+    yield database
+    database.close()
+
+
+def add_entries(db: Database, chat_handle: str, user_ids):
+    # One message a day, from each user in turn
+    chat_log = db.get_chat_log(chat_handle)
+    chat_log.add_entries([
+        LogEntry(START + datetime.timedelta(days=num), LogEntry.TYPE_TEXT, user_id, f"message {num}", num + 1, 0)
+        for num, user_id in enumerate(user_ids)
+    ])
+    db.clear_dirty_log_dates(chat_handle, db.list_dirty_log_dates(chat_handle))
+
+
+def test_renamed_users_mark_only_their_days_dirty(db):
+    add_entries(db, "100", [1, 2, 3, 1])
+    add_entries(db, "200", [3, 3, 2])
+    db.QUERY_CHUNK_SIZE = 1
+    db.mark_user_log_dates_dirty({1, 2})
+    day = datetime.timedelta(days=1)
+    assert db.list_dirty_log_dates("100") == [START.date(), START.date() + day, START.date() + 3 * day]
+    assert db.list_dirty_log_dates("200") == [START.date() + 2 * day]
+
+
+def test_migration_rebuilds_rollups(db):
+    add_entries(db, "100", [1, 2, 1])
+    # As a database from before the rollups existed would be
+    for table in [db.daily_user_stats, db.hourly_stats, db.participants]:
+        db.conn.execute(table.delete())
+    db.set_schema_version(4)
+    db.close()
+
+    migrated = Database(db.db_str)
+    assert migrated.get_schema_version() == len(migrated.migrations)
+    assert {row.user_id: row.messages for row in migrated.get_user_stats("100")} == {1: 2, 2: 1}
+    assert migrated.list_user_ids(["100"]) == {1, 2}
+    migrated.close()
+
+
+def test_aware_datetimes_are_stored_as_utc(db):
+    # Just after midnight in UTC+2 is still the previous day in UTC
+    local_time = datetime.datetime(2021, 3, 2, 1, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+    db.get_chat_log("100").add_entries([LogEntry(local_time, LogEntry.TYPE_TEXT, 1, "late", 1, 0)])
+    assert db.list_log_entries("100", None)[0].log_datetime == datetime.datetime(2021, 3, 1, 23, 30)
+    assert db.list_log_dates("100") == [datetime.date(2021, 3, 1)]
+    stats = [(row.hour, row.messages) for row in db.get_hourly_stats("100")]
+    assert stats == [(23, 1)]
+    db.rebuild_stats("100")
+    assert [(row.hour, row.messages) for row in db.get_hourly_stats("100")] == stats
@@ -0,0 +1,32 @@
+import asyncio
+import datetime
+
+import pytest
+
+from benchmarks.fake_client import FakeChat, FakeClient, FakeUser
+from telegram_logger.database import Database
+from telegram_logger.entity_cache import EntityCache
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(f"sqlite:///{tmp_path / 'test.db'}")
+    yield database
+    database.close()
+
+
+def test_stale_names_are_looked_up_again_in_the_same_process(db):
+    client = FakeClient({"100": FakeChat(100, "chat")}, {"100": []}, {1: FakeUser(1, "Alice")})
+    entity_cache = EntityCache(db)
+    asyncio.run(entity_cache.load_users(client, [1]))
+    client.users[1].first_name = "Alicia"
+
+    asyncio.run(entity_cache.load_users(client, [1]))
+    assert entity_cache.user_name(1) == "Alice"
+    assert client.request_counts["get_entity"] == 1
+
+    # Once the name is stale, as it would be a day later in the long running daemon
+    entity_cache.ttl = datetime.timedelta(0)
+    asyncio.run(entity_cache.load_users(client, [1]))
+    assert entity_cache.user_name(1) == "Alicia"
+    assert client.request_counts["get_entity"] == 2
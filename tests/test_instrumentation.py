@@ -0,0 +1,30 @@
+import asyncio
+
+from telethon.tl.functions.messages import GetHistoryRequest
+
+from telegram_logger.instrumentation import Instrumentation
+
+
+class PagedClient:
+    # Stands in for TelegramClient, whose helpers send every request through _call()
+    async def __call__(self, request):
+        return await self._call(None, request)
+
+    async def _call(self, sender, request):
+        return request.offset_id
+
+    async def iter_messages(self, pages: int):
+        for page in range(pages):
+            for message in range(await self(GetHistoryRequest(None, page, None, 0, 100, 0, 0, 0))):
+                yield message
+
+
+def test_every_history_page_is_recorded():
+    instrumentation = Instrumentation()
+    client = instrumentation.instrument_client_class(PagedClient)()
+
+    async def scrape():
+        return [message async for message in client.iter_messages(3)]
+
+    assert len(asyncio.run(scrape())) == 3
+    assert instrumentation.timings["rpc"]["GetHistoryRequest"].count == 3
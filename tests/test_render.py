@@ -0,0 +1,80 @@
+import asyncio
+import datetime
+import os
+
+import pytest
+
+from telegram_logger.data_store import DataStore
+from telegram_logger.database import Database
+from telegram_logger.log_entry import LogEntry
+
+START = datetime.datetime(2015, 1, 1, 12)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # With no busy timeout, a write while the workers are reading fails at once rather than after a wait
+    database = Database(f"sqlite:///{tmp_path / 'test.db'}?timeout=0")
+    yield database
+    database.close()
+
+
+def add_entries(db: Database, chat_handle: str, day_count: int, per_day: int):
+    chat_log = db.get_chat_log(chat_handle)
+    chat_log.add_entries([
+        LogEntry(START + datetime.timedelta(days=num // per_day, seconds=num % per_day), LogEntry.TYPE_TEXT,
+                 1 + num % 3, f"message {num}", num + 1, 0)
+        for num in range(day_count * per_day)
+    ], batch_size=None)
+    chat_log.flush_entries()
+
+
+def test_render_with_several_workers(db):
+    # The small chat's days are finished while the big chat's workers are still reading
+    add_entries(db, "small", 2, 10)
+    add_entries(db, "big", 1000, 100)
+    data_store = DataStore(db, ["small", "big"])
+    data_store.load_user_ids()
+    entity_cache = data_store.entity_cache
+    entity_cache.names = {(entity_cache.TYPE_USER, str(user_id)): (f"user{user_id}",) * 2 for user_id in range(1, 4)}
+    entity_cache.names.update({(entity_cache.TYPE_CHAT, handle): (f"#{handle}",) * 2 for handle in ["small", "big"]})
+
+    asyncio.run(data_store.write_all_logs(None, render_workers=2))
+
+    assert db.list_dirty_log_dates("small") == db.list_dirty_log_dates("big") == []
+    assert os.path.exists("irclogs/2015/#small.01-02.log")
+    with open("irclogs/2017/#big.09-26.log", encoding="utf-8") as f:
+        assert len(f.read().splitlines()) == 102
+
+
+def test_offline_keeps_output_for_names_never_looked_up(db):
+    # As after an upgrade, the logs were written before names were cached, so only the rendered names are known
+    add_entries(db, "100", 2, 1)
+    db.update_rendered_user_names({1: "alice"})
+    db.update_rendered_chat_names({"100": "#chat"})
+    os.makedirs("irclogs/2015")
+    with open("irclogs/2015/#chat.01-02.log", "w", encoding="utf-8") as f:
+        f.write("existing log")
+    os.makedirs("pisg_output/user_pics")
+    with open("pisg_output/user_pics/1.png", "wb") as f:
+        f.write(b"picture")
+    data_store = DataStore(db, ["100"])
+    data_store.load_user_ids()
+
+    asyncio.run(data_store.write_all_logs(None))
+    asyncio.run(data_store.write_users_cfg(None))
+    asyncio.run(data_store.write_channel_cfg(None))
+
+    # The first day only has alice, the second has user 2 as well, whose name is not known
+    with open("irclogs/2015/#chat.01-01.log", encoding="utf-8") as f:
+        assert "12:00:00 < alice> message 0" in f.read()
+    with open("irclogs/2015/#chat.01-02.log", encoding="utf-8") as f:
+        assert f.read() == "existing log"
+    assert db.list_dirty_log_dates("100") == [START.date() + datetime.timedelta(days=1)]
+    assert db.get_rendered_user_names() == {1: "alice"}
+    assert os.path.exists("pisg_output/user_pics/1.png")
+    with open("users.cfg", encoding="utf-8") as f:
+        assert f.read() == '<user nick="alice" pic="user_pics/1.png">'
+    with open("chats.cfg", encoding="utf-8") as f:
+        assert 'Logfile = "irclogs/*/#chat*.log*"' in f.read()
@@ -0,0 +1,102 @@
+import asyncio
+import datetime
+
+import pytest
+from telethon.errors import FloodWaitError
+from tqdm import tqdm
+
+from benchmarks.fake_client import FakeChat, FakeClient, FakeMessage, FakeUser
+from telegram_logger.database import Database
+from telegram_logger.database_writer import DatabaseWriter
+from telegram_logger.scrape_scheduler import ScrapeScheduler
+
+START = datetime.datetime(2021, 3, 1, tzinfo=datetime.timezone.utc)
+
+
+def make_client(message_count: int = 60) -> FakeClient:
+    users = {user_id: FakeUser(user_id, f"User{user_id}") for user_id in range(1, 4)}
+    chats = {"100": FakeChat(100, "chat one"), "200": FakeChat(200, "chat two")}
+    histories = {
+        handle: [
+            FakeMessage(message_id, START + datetime.timedelta(minutes=message_id), users[1 + message_id % 3],
+                        text=f"message {message_id}")
+            for message_id in range(1, message_count + 1)
+        ]
+        for handle in chats
+    }
+    return FakeClient(chats, histories, users)
+
+
+def stored_message_ids(db: Database, chat_handle: str):
+    return [entry.message_id for entry in db.list_log_entries(chat_handle, None)]
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(f"sqlite:///{tmp_path / 'test.db'}")
+    yield database
+    database.close()
+
+
+def test_scrape_retries_after_flood_wait(db):
+    client = make_client()
+    client.inject_flood_wait("100", 30, after_messages=25)
+    client.inject_flood_wait("200", 5, after_messages=0)
+    chat_logs = [db.get_chat_log("100"), db.get_chat_log("200")]
+    sleeps = []
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+
+    asyncio.run(ScrapeScheduler(client, concurrency=2, batch_size=7, sleep=fake_sleep).scrape_all(chat_logs))
+
+    assert sorted(sleeps) == [5, 30]
+    for chat_handle in ["100", "200"]:
+        assert stored_message_ids(db, chat_handle) == list(range(1, 61))
+        assert db.get_chat_log(chat_handle).last_message_id == 60
+        assert db.list_fetched_ranges(chat_handle) == [(1, 60)]
+
+
+def test_interrupted_scrape_resumes_from_checkpoint(db):
+    client = make_client()
+    client.inject_flood_wait("100", 30, after_messages=25)
+
+    async def scrape(chat_log):
+        async with DatabaseWriter() as writer:
+            await chat_log.scrape_messages(client, tqdm(total=0, disable=True), writer, batch_size=10)
+
+    with pytest.raises(FloodWaitError):
+        asyncio.run(scrape(db.get_chat_log("100")))
+    # The messages fetched before the flood wait are committed along with their checkpoint
+    reopened = Database(db.db_str)
+    assert reopened.get_chat_log("100").last_message_id == 25
+    assert stored_message_ids(reopened, "100") == list(range(1, 26))
+
+    asyncio.run(scrape(reopened.get_chat_log("100")))
+    assert stored_message_ids(reopened, "100") == list(range(1, 61))
+    assert reopened.get_chat_log("100").last_message_id == 60
+    reopened.close()
+
+
+def test_scrape_fills_gaps_below_checkpoint(db):
+    client = make_client()
+    asyncio.run(ScrapeScheduler(client, batch_size=7).scrape_all([db.get_chat_log("100")]))
+    db.remove_fetched_range("100", 10, 19)
+    db.conn.execute(
+        db.log_entries.delete().where(db.log_entries.columns.message_id.between(10, 19))
+    )
+    assert db.list_missing_ranges("100", 60) == [(10, 19)]
+
+    asyncio.run(ScrapeScheduler(client, batch_size=7).scrape_all([db.get_chat_log("100")]))
+    assert stored_message_ids(db, "100") == list(range(1, 61))
+    assert db.list_missing_ranges("100", 60) == []
+
+
+def test_scrape_into_in_memory_database():
+    # The writer thread has to see the same in-memory database as the event loop's thread
+    db = Database("sqlite://")
+    asyncio.run(ScrapeScheduler(make_client(), batch_size=7).scrape_all([db.get_chat_log("100")]))
+    assert stored_message_ids(db, "100") == list(range(1, 61))
+    assert db.get_chat_log("100").last_message_id == 60
+    db.close()
+